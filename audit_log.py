@@ -0,0 +1,185 @@
+import os
+import re
+import glob
+import gzip
+import json
+import heapq
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class AuditLog:
+    """Журнал действий администраторов и отказов в доступе.
+
+    Записи копятся в памяти и пишутся пачками в отдельном потоке,
+    чтобы не блокировать event loop. Файл в формате JSON Lines,
+    при превышении max_bytes ротируется в audit.log.1.gz, .2.gz и т.д.
+
+    С replica_id каждая реплика пишет и ротирует свой файл
+    (audit.<replica_id>.log), а query читает все файлы рядом с path.
+    """
+
+    def __init__(self, path: str = "audit.log", max_bytes: int = 5 * 1024 * 1024,
+                 backups: int = 10, flush_interval: float = 1.0, batch_size: int = 200,
+                 replica_id: Optional[str] = None):
+        self.base_path = path
+        if replica_id:
+            root, ext = os.path.splitext(path)
+            safe_id = re.sub(r'[^\w.-]', '_', replica_id)
+            self.path = f"{root}.{safe_id}{ext}"
+        else:
+            self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pending: List[dict] = []
+        self._wakeup = asyncio.Event()
+        self._write_lock = asyncio.Lock()
+
+    def record(self, action: str, actor: Optional[int], target: Optional[int] = None, **details):
+        """Добавить запись (без ввода-вывода, безопасно вызывать из обработчиков)"""
+        entry = {'ts': round(time.time(), 3), 'action': action, 'actor': actor}
+        if target is not None:
+            entry['target'] = target
+        entry.update(details)
+        self._pending.append(entry)
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        """Записать накопленные записи на диск"""
+        async with self._write_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, []
+            try:
+                await asyncio.to_thread(self._write_batch, batch)
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи журнала аудита: {e}")
+                # Вернем записи в очередь, чтобы не потерять их
+                self._pending = batch + self._pending
+                return
+
+            # Пачка уже на диске: ошибка ротации не должна возвращать ее в очередь
+            try:
+                await asyncio.to_thread(self._rotate_if_needed)
+            except Exception as e:
+                logger.error(f"❌ Ошибка ротации журнала аудита: {e}")
+
+    async def run(self):
+        """Фоновая запись журнала"""
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                await self.flush()
+        finally:
+            await self.flush()
+
+    def _write_batch(self, batch: List[dict]):
+        data = ''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in batch)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(data)
+
+    def _rotate_if_needed(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            self._rotate()
+
+    def _backup_path(self, index: int, path: Optional[str] = None) -> str:
+        return f"{path or self.path}.{index}.gz"
+
+    def _rotate(self):
+        """Сдвинуть архивы и сжать текущий файл в .1.gz"""
+        oldest = self._backup_path(self.backups)
+        if os.path.exists(oldest):
+            os.remove(oldest)
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(self._backup_path(index)):
+                os.replace(self._backup_path(index), self._backup_path(index + 1))
+
+        tmp_path = f"{self._backup_path(1)}.tmp"
+        with open(self.path, 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+            while True:
+                chunk = src.read(1024 * 1024)
+                if not chunk:
+                    break
+                dst.write(chunk)
+        os.replace(tmp_path, self._backup_path(1))
+        os.remove(self.path)
+        logger.info(f"🗜️ Журнал аудита ротирован: {self._backup_path(1)}")
+
+    def _streams(self) -> List[str]:
+        """Журналы всех реплик рядом с base_path (по живому файлу или архивам)"""
+        root, ext = os.path.splitext(self.base_path)
+        archive = re.compile(r'\.\d+\.gz$')
+        streams = {self.path}
+        for pattern in (f"{glob.escape(self.base_path)}*", f"{glob.escape(root)}.*{glob.escape(ext)}*"):
+            for path in glob.glob(pattern):
+                stream = archive.sub('', path)
+                if stream.endswith(ext):
+                    streams.add(stream)
+        return sorted(streams)
+
+    def _files(self, stream: str, since: Optional[float]) -> List[str]:
+        """Файлы одного журнала от старых к новым, без архивов целиком старше since"""
+        files = []
+        for index in range(self.backups, 0, -1):
+            path = self._backup_path(index, stream)
+            if not os.path.exists(path):
+                continue
+            # Архив не меняется после ротации: его mtime - время последней записи
+            if since is not None and os.path.getmtime(path) < since:
+                continue
+            files.append(path)
+        if os.path.exists(stream):
+            files.append(stream)
+        return files
+
+    def _iter_stream(self, stream: str, since: Optional[float]) -> Iterator[dict]:
+        for path in self._files(stream, since):
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+
+    def _iter_entries(self, since: Optional[float]) -> Iterator[dict]:
+        """Записи всех реплик по времени: каждый журнал уже упорядочен"""
+        streams = [self._iter_stream(stream, since) for stream in self._streams()]
+        return heapq.merge(*streams, key=lambda entry: entry.get('ts', 0))
+
+    def query(self, user_id: Optional[int] = None, action: Optional[str] = None,
+              since: Optional[float] = None, until: Optional[float] = None,
+              offset: int = 0, limit: int = 20) -> Tuple[List[dict], int]:
+        """Найти записи, новые первыми. Возвращает страницу и общее число совпадений.
+
+        Журнал читается потоково, в памяти держится не больше offset + limit записей.
+        """
+        window = deque(maxlen=offset + limit)
+        total = 0
+        for entry in self._iter_entries(since):
+            ts = entry.get('ts', 0)
+            if since is not None and ts < since:
+                continue
+            if until is not None and ts > until:
+                continue
+            if action is not None and entry.get('action') != action:
+                continue
+            if user_id is not None and user_id not in (entry.get('actor'), entry.get('target')):
+                continue
+            total += 1
+            window.append(entry)
+
+        newest_first = list(reversed(window))
+        return newest_first[offset:offset + limit], total
@@ -0,0 +1,163 @@
+"""Замер задержки answer_photo / answer_document на локальных заглушках Bot API.
+
+Запуск: python bench_bot_api.py [--requests 200] [--concurrency 4]
+                                [--public-latency-ms 40] [--latency-ms 0]
+
+Две заглушки принимают sendPhoto/sendDocument как настоящий сервер
+telegram-bot-api. "Публичная" моделирует api.telegram.org: каждый ответ
+задерживается на --public-latency-ms (сетевой round trip), а первый
+запрос на новом соединении - еще на два round trip (TCP + TLS).
+"Своя" моделирует telegram-bot-api рядом с ботом (BOT_API_URL) и
+отвечает через --latency-ms.
+
+До: сессия aiogram по умолчанию и сессия без переиспользования
+соединений против публичной заглушки. После: сессия из
+bot_session.create_bot_session с BOT_API_URL на свою заглушку.
+"""
+import time
+import asyncio
+import argparse
+import statistics
+from io import BytesIO
+
+import qrcode
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import BufferedInputFile, Message
+
+from bot_session import create_bot_session
+
+TOKEN = "123456:bench"
+
+
+def make_standin(latency: float, handshake: float = 0.0) -> web.Application:
+    """Минимальный сервер с API Telegram Bot API.
+
+    handshake - дополнительная задержка первого запроса на каждом соединении.
+    """
+    connections = set()
+
+    async def handle(request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        # Читаем тело целиком, как настоящий сервер
+        await request.read()
+        delay = latency
+        transport = request.transport
+        if handshake and transport is not None and transport not in connections:
+            connections.add(transport)
+            delay += handshake
+        if delay:
+            await asyncio.sleep(delay)
+
+        result = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': 1, 'type': 'private'}}
+        if method.lower() == 'sendphoto':
+            result['photo'] = [{'file_id': 'p', 'file_unique_id': 'p', 'width': 330, 'height': 330}]
+        elif method.lower() == 'senddocument':
+            result['document'] = {'file_id': 'd', 'file_unique_id': 'd'}
+        return web.json_response({'ok': True, 'result': result})
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', handle)
+    return app
+
+
+def make_qr_png() -> bytes:
+    """Такой же QR, как отправляет бот"""
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data("tg://login?token=" + "A" * 43)
+    qr.make(fit=True)
+    bio = BytesIO()
+    qr.make_image(fill_color="black", back_color="white").save(bio, 'PNG')
+    return bio.getvalue()
+
+
+async def measure(session: AiohttpSession, requests: int, concurrency: int):
+    """Задержки answer_photo и answer_document в миллисекундах"""
+    bot = Bot(token=TOKEN, session=session)
+    message = Message.model_validate(
+        {'message_id': 1, 'date': int(time.time()), 'chat': {'id': 1, 'type': 'private'}},
+        context={'bot': bot},
+    )
+    photo = make_qr_png()
+    document = ("1" + "A" * 352).encode('utf-8')
+
+    async def photo_call():
+        await bot(message.answer_photo(photo=BufferedInputFile(photo, "qr_code.png"), caption="QR"))
+
+    async def document_call():
+        await bot(message.answer_document(
+            document=BufferedInputFile(document, "telegram_session.txt"), caption="session"
+        ))
+
+    results = {}
+    try:
+        for name, call in (('answer_photo', photo_call), ('answer_document', document_call)):
+            await call()  # прогрев
+            timings = []
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def timed():
+                async with semaphore:
+                    started = time.perf_counter()
+                    await call()
+                    timings.append((time.perf_counter() - started) * 1000)
+
+            await asyncio.gather(*(timed() for _ in range(requests)))
+            timings.sort()
+            results[name] = (
+                statistics.median(timings),
+                timings[int(len(timings) * 0.95) - 1],
+                statistics.mean(timings),
+            )
+    finally:
+        await bot.session.close()
+    return results
+
+
+async def start_standin(app: web.Application):
+    """Запустить заглушку на свободном порту, вернуть (runner, base url)"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--public-latency-ms', type=float, default=40,
+                        help='round trip до api.telegram.org')
+    parser.add_argument('--latency-ms', type=float, default=0,
+                        help='round trip до своего telegram-bot-api')
+    args = parser.parse_args()
+
+    public_rtt = args.public_latency_ms / 1000
+    public_runner, public = await start_standin(make_standin(public_rtt, handshake=2 * public_rtt))
+    local_runner, local = await start_standin(make_standin(args.latency_ms / 1000))
+
+    configs = {
+        'before: default': lambda: AiohttpSession(api=TelegramAPIServer.from_base(public)),
+        'before: no reuse': lambda: create_bot_session(api_url=public, reuse_connections=False),
+        'after: BOT_API_URL': lambda: create_bot_session(api_url=local),
+    }
+
+    print(f"requests={args.requests} concurrency={args.concurrency} "
+          f"public={args.public_latency_ms}ms self-hosted={args.latency_ms}ms")
+    print(f"{'session':<22}{'method':<18}{'p50 ms':>9}{'p95 ms':>9}{'mean ms':>9}")
+    try:
+        for label, factory in configs.items():
+            results = await measure(factory(), args.requests, args.concurrency)
+            for method, (p50, p95, mean) in results.items():
+                print(f"{label:<22}{method:<18}{p50:>9.2f}{p95:>9.2f}{mean:>9.2f}")
+    finally:
+        await public_runner.cleanup()
+        await local_runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -5,9 +5,20 @@ import random
 import qrcode
 import json
 import re
+import time
+import heapq
+import signal
+import socket
 from io import BytesIO
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import Dict, List, Set
+from typing import Dict, List, Optional, Set
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: блокировки файлов нет, белый список пишет один процесс
+    fcntl = None
 
 # Настройка логирования
 logging.basicConfig(
@@ -17,12 +28,13 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 try:
-    from aiogram import Bot, Dispatcher, Router, F
-    from aiogram.types import Message, CallbackQuery, BufferedInputFile
+    from aiogram import Bot, Dispatcher, Router, F, BaseMiddleware
+    from aiogram.types import Message, CallbackQuery, BufferedInputFile, Update
     from aiogram.filters import Command, CommandStart
     from aiogram.fsm.context import FSMContext
     from aiogram.fsm.state import State, StatesGroup
     from aiogram.utils.keyboard import InlineKeyboardBuilder
+    from aiogram.exceptions import TelegramAPIError
     from telethon import TelegramClient
     from telethon.sessions import StringSession
     from telethon.errors import (
@@ -36,7 +48,23 @@ except ImportError as e:
     print(f"❌ Missing dependencies: {e}")
     exit(1)
 
+from state_store import StateStore, StateStoreError, create_state_store
+from whitelist_snapshot import SnapshotError, WhitelistSnapshot, write_snapshot
+from audit_log import AuditLog
+from bot_session import create_bot_session
+
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
+
+# HTTP-сессия Bot API
+# BOT_API_URL - адрес своего сервера telegram-bot-api (например http://localhost:8081)
+BOT_API_URL = os.environ.get('BOT_API_URL', '')
+BOT_API_LOCAL = os.environ.get('BOT_API_LOCAL', '').lower() in ('1', 'true', 'yes')
+BOT_API_POOL_LIMIT = int(os.environ.get('BOT_API_POOL_LIMIT', '100'))
+BOT_API_POOL_PER_HOST = int(os.environ.get('BOT_API_POOL_PER_HOST', '0'))
+BOT_API_KEEPALIVE = float(os.environ.get('BOT_API_KEEPALIVE', '60'))
+BOT_API_REUSE_CONNECTIONS = os.environ.get('BOT_API_REUSE_CONNECTIONS', 'true').lower() in ('1', 'true', 'yes')
+BOT_API_TIMEOUT = float(os.environ.get('BOT_API_TIMEOUT', '60'))
+BOT_API_UPLOAD_TIMEOUT = float(os.environ.get('BOT_API_UPLOAD_TIMEOUT', '120'))
 API_ID = int(os.environ.get('API_ID', '4'))
 API_HASH = os.environ.get('API_HASH', '014b35b6184100b085b0d0572f9b5103')
 
@@ -94,94 +122,638 @@ if not ADMIN_IDS:
 
 logger.info(f"👑 Final Admin IDs: {ADMIN_IDS}")
 
+# ==============================================
+# НЕСКОЛЬКО РЕПЛИК
+# ==============================================
+# memory - одна реплика, состояние в памяти процесса
+# sqlite - общее состояние в STATE_DB_PATH (реплики на одном хосте)
+# redis  - общее состояние на сервере REDIS_URL (любой совместимый с Redis)
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'memory')
+REPLICA_ID = os.environ.get('REPLICA_ID') or f"{socket.gethostname()}-{os.getpid()}"
+HEARTBEAT_INTERVAL = float(os.environ.get('HEARTBEAT_INTERVAL', '5'))
+REPLICA_TTL = HEARTBEAT_INTERVAL * 3
+# Владение сессией живет дольше ожидания QR (120 сек), поэтому не продлевается
+SESSION_OWNER_TTL = 180
+DRAIN_TIMEOUT = float(os.environ.get('DRAIN_TIMEOUT', '150'))
+
+# Ожидание сканирования QR: не дольше QR_WAIT_TIMEOUT и срока жизни токена
+QR_WAIT_TIMEOUT = 120
+
+try:
+    state_store: Optional[StateStore] = create_state_store(STATE_BACKEND)
+except StateStoreError as e:
+    print(f"❌ State store error: {e}")
+    exit(1)
+
+logger.info(f"🧩 State backend: {STATE_BACKEND}, replica: {REPLICA_ID}")
+
+# Журнал аудита
+AUDIT_LOG_PATH = os.environ.get('AUDIT_LOG_PATH', 'audit.log')
+AUDIT_MAX_BYTES = int(os.environ.get('AUDIT_MAX_BYTES', str(5 * 1024 * 1024)))
+AUDIT_BACKUPS = int(os.environ.get('AUDIT_BACKUPS', '10'))
+AUDIT_PAGE_SIZE = 20
+
+# С несколькими репликами у каждой свой файл: общий файл они ротировали бы наперегонки
+audit_log = AuditLog(
+    AUDIT_LOG_PATH, max_bytes=AUDIT_MAX_BYTES, backups=AUDIT_BACKUPS,
+    replica_id=REPLICA_ID if state_store is not None else None,
+)
+
 def is_admin(user_id: int) -> bool:
     """Проверка, является ли пользователь админом"""
     result = user_id in ADMIN_IDS
     logger.info(f"🔍 Checking admin status for {user_id}: {result}")
     return result
 
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+def parse_duration(text: str) -> Optional[int]:
+    """Разобрать срок вида 30m, 12h, 7d или 1d12h в секунды"""
+    text = text.strip().lower()
+    parts = re.findall(r'(\d+)([smhdw])', text)
+    if not parts or ''.join(n + u for n, u in parts) != text:
+        return None
+    seconds = sum(int(n) * DURATION_UNITS[u] for n, u in parts)
+    return seconds or None
+
+def format_remaining(seconds: float) -> str:
+    """Оставшееся время в виде '1д 2ч 5м'"""
+    seconds = int(seconds)
+    days, rest = divmod(seconds, 86400)
+    hours, rest = divmod(rest, 3600)
+    minutes, secs = divmod(rest, 60)
+    
+    parts = []
+    if days:
+        parts.append(f"{days}д")
+    if hours:
+        parts.append(f"{hours}ч")
+    if minutes:
+        parts.append(f"{minutes}м")
+    if not parts:
+        parts.append(f"{secs}с")
+    return ' '.join(parts)
+
 class SessionStates(StatesGroup):
     ADD_USER = State()
     REMOVE_USER = State()
 
-bot = Bot(token=BOT_TOKEN)
+if BOT_API_URL:
+    logger.info(f"🌐 Using Bot API server: {BOT_API_URL} (local={BOT_API_LOCAL})")
+
+bot = Bot(
+    token=BOT_TOKEN,
+    session=create_bot_session(
+        api_url=BOT_API_URL,
+        is_local=BOT_API_LOCAL,
+        pool_limit=BOT_API_POOL_LIMIT,
+        pool_per_host=BOT_API_POOL_PER_HOST,
+        keepalive_timeout=BOT_API_KEEPALIVE,
+        reuse_connections=BOT_API_REUSE_CONNECTIONS,
+        timeout=BOT_API_TIMEOUT,
+    ),
+)
 dp = Dispatcher()
 router = Router()
 dp.include_router(router)
 
+class WhitelistSaveError(Exception):
+    """Изменение белого списка не удалось записать на диск"""
+
 class WhiteListManager:
-    def __init__(self, filename: str = "whitelist.json"):
+    # После стольких изменений дельта сливается в новый снимок
+    COMPACT_THRESHOLD = 1000
+    # Как часто проверять, не обновили ли снимок другие процессы
+    RELOAD_INTERVAL = 1.0
+    # Как часто планировщик перечитывает сроки из общего хранилища
+    EXPIRY_RESYNC_INTERVAL = 60.0
+    
+    def __init__(self, filename: str = "whitelist.json", store: Optional[StateStore] = None,
+                 audit: Optional[AuditLog] = None):
         self.filename = filename
-        self.allowed_users: Set[int] = set()
+        self.store = store
+        self.audit = audit
+        base = os.path.splitext(filename)[0]
+        self.snapshot_path = f"{base}.bin"
+        self.delta_path = f"{base}.delta.json"
+        self.grants_path = f"{base}.grants.json"
+        self.lock_path = f"{base}.lock"
+        self.snapshot: Optional[WhitelistSnapshot] = None
+        # Изменения поверх снимка: added не пересекается со снимком, removed - его подмножество
+        self.added: Set[int] = set()
+        self.removed: Set[int] = set()
+        self._delta_mtime = None
+        self._next_reload_check = 0.0
+        # Временные доступы: user_id -> время истечения (unix time).
+        # Куча хранит те же пары; устаревшие записи пропускаются при извлечении
+        self.expirations: Dict[int, float] = {}
+        self._expiry_heap: List[tuple] = []
+        self._expiry_changed = asyncio.Event()
         self.load()
+        self.load_expirations()
     
     def load(self):
-        """Загрузить белый список из файла"""
+        """Загрузить белый список"""
         try:
-            if os.path.exists(self.filename):
-                with open(self.filename, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.allowed_users = set(data.get('allowed_users', []))
-                    logger.info(f"✅ Белый список загружен: {len(self.allowed_users)} пользователей")
-            else:
-                self.save()
+            if self.store is not None:
+                self.load_from_store()
+                return
+            
+            with self._file_lock():
+                self._load_files()
+            logger.info(f"✅ Белый список загружен: {self._count_local()} пользователей")
+        except SnapshotError:
+            # Восстанавливать молча нельзя - пусть администратор решит, что делать с файлом
+            raise
         except Exception as e:
+            # При ошибке загрузки ничего не пишем: файлы остаются как есть,
+            # до успешной перезагрузки список пуст только в памяти
             logger.error(f"❌ Ошибка загрузки белого списка: {e}")
-            self.allowed_users = set()
+            if self.snapshot is not None:
+                self.snapshot.close()
+                self.snapshot = None
+            self.added.clear()
+            self.removed.clear()
     
-    def save(self):
-        """Сохранить белый список в файл"""
+    def _load_files(self):
+        """Открыть снимок и дельту (под файловой блокировкой)"""
+        if not os.path.exists(self.snapshot_path):
+            # Первый запуск со снимком - переносим старый JSON
+            user_ids = self._read_legacy_json()
+            write_snapshot(self.snapshot_path, user_ids)
+            self._retire_legacy_json()
+        
+        self._open_snapshot()
+        self._load_delta()
+    
+    @contextmanager
+    def _file_lock(self):
+        """Эксклюзивная блокировка файлов белого списка между процессами"""
+        with open(self.lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            # Блокировка снимается при закрытии файла
+            yield
+    
+    def _refresh(self):
+        """Перечитать снимок (если сменился) и дельту без троттлинга.
+        
+        Вызывается под файловой блокировкой перед каждым изменением,
+        чтобы не затереть правки других процессов.
+        """
+        if self.snapshot is None:
+            self._load_files()
+            return
+        stat = os.stat(self.snapshot_path)
+        if (stat.st_ino, stat.st_mtime_ns) != self.snapshot.identity:
+            self._open_snapshot()
+        self._load_delta()
+    
+    def _mutate(self, apply):
+        """Применить apply() к свежей копии списка и записать результат.
+        
+        apply меняет added/removed и возвращает результат; если он пустой,
+        писать нечего. При ошибке поднимается WhitelistSaveError, а память
+        перечитывается с диска при следующей проверке.
+        """
         try:
-            data = {'allowed_users': list(self.allowed_users)}
-            with open(self.filename, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            with self._file_lock():
+                self._refresh()
+                result = apply()
+                if result:
+                    self.save()
+                return result
         except Exception as e:
             logger.error(f"❌ Ошибка сохранения белого списка: {e}")
+            self._delta_mtime = self._next_reload_check = 0.0
+            raise WhitelistSaveError(str(e)) from e
     
-    def add_user(self, user_id: int) -> bool:
-        """Добавить пользователя в белый список"""
-        if user_id not in self.allowed_users:
-            self.allowed_users.add(user_id)
-            self.save()
-            logger.info(f"➕ Добавлен пользователь {user_id} в белый список")
+    def _read_legacy_json(self) -> List[int]:
+        """Пользователи из старого whitelist.json (пусто, если файла нет)"""
+        if not os.path.exists(self.filename):
+            return []
+        with open(self.filename, 'r', encoding='utf-8') as f:
+            return [int(u) for u in json.load(f).get('allowed_users', [])]
+    
+    def _retire_legacy_json(self):
+        """Убрать перенесенный JSON, чтобы его нельзя было импортировать повторно"""
+        if os.path.exists(self.filename):
+            os.replace(self.filename, f"{self.filename}.migrated")
+            logger.info(f"📦 Белый список перенесен из {self.filename}, файл переименован в {self.filename}.migrated")
+    
+    def load_from_store(self):
+        """Загрузить белый список из общего хранилища"""
+        count = len(self.store.wl_all())
+        
+        # Первый запуск с общим хранилищем - переносим старый файл
+        if not count and os.path.exists(self.filename):
+            for user_id in self._read_legacy_json():
+                self.store.wl_add(user_id)
+            count = len(self.store.wl_all())
+            self._retire_legacy_json()
+        
+        logger.info(f"✅ Белый список загружен из хранилища: {count} пользователей")
+    
+    def _open_snapshot(self):
+        """Открыть (или переоткрыть) снимок через mmap"""
+        snapshot = WhitelistSnapshot(self.snapshot_path)
+        if self.snapshot is not None:
+            self.snapshot.close()
+        self.snapshot = snapshot
+    
+    def _load_delta(self):
+        """Прочитать журнал изменений поверх снимка"""
+        if os.path.exists(self.delta_path):
+            with open(self.delta_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.added = {u for u in data.get('added', []) if u not in self.snapshot}
+            self.removed = {u for u in data.get('removed', []) if u in self.snapshot}
+            self._delta_mtime = os.stat(self.delta_path).st_mtime_ns
+        else:
+            self.added = set()
+            self.removed = set()
+            self._delta_mtime = None
+    
+    def _maybe_reload(self):
+        """Подхватить снимок и дельту, записанные другим процессом"""
+        now = time.monotonic()
+        if now < self._next_reload_check:
+            return
+        self._next_reload_check = now + self.RELOAD_INTERVAL
+        
+        if self.snapshot is None:
+            # Прошлая загрузка не удалась - пробуем снова
+            try:
+                self.load()
+            except SnapshotError as e:
+                logger.error(f"❌ Снимок белого списка поврежден: {e}")
+            return
+        
+        try:
+            stat = os.stat(self.snapshot_path)
+            if (stat.st_ino, stat.st_mtime_ns) != self.snapshot.identity:
+                self._open_snapshot()
+                self._load_delta()
+                return
+            
+            delta_mtime = os.stat(self.delta_path).st_mtime_ns if os.path.exists(self.delta_path) else None
+            if delta_mtime != self._delta_mtime:
+                self._load_delta()
+        except Exception as e:
+            logger.error(f"❌ Ошибка перезагрузки белого списка: {e}")
+    
+    def save(self):
+        """Сохранить изменения белого списка (вызывается под файловой блокировкой)"""
+        if self.store is not None:
+            # Общее хранилище пишется сразу при каждом изменении
+            return
+        if self.snapshot is None:
+            # Без загруженного снимка дельта затерла бы настоящую на диске
+            raise WhitelistSaveError("белый список не загружен")
+        if len(self.added) + len(self.removed) >= self.COMPACT_THRESHOLD:
+            self.compact()
+            return
+        
+        # Пишем только дельту - это дешево при любом размере списка
+        data = {'added': sorted(self.added), 'removed': sorted(self.removed)}
+        tmp_path = f"{self.delta_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.delta_path)
+        self._delta_mtime = os.stat(self.delta_path).st_mtime_ns
+    
+    def _replace_snapshot(self, user_ids: List[int]):
+        """Записать новый снимок и сбросить дельту (под файловой блокировкой)"""
+        write_snapshot(self.snapshot_path, user_ids)
+        self._open_snapshot()
+        self.added.clear()
+        self.removed.clear()
+        if os.path.exists(self.delta_path):
+            os.remove(self.delta_path)
+        self._delta_mtime = None
+    
+    def compact(self):
+        """Слить дельту в новый снимок"""
+        self._replace_snapshot(self._merged_users())
+        logger.info(f"🗜️ Снимок белого списка обновлен: {len(self.snapshot)} пользователей")
+    
+    async def _store_call(self, func, *args):
+        """Вызов блокирующего хранилища вне event loop"""
+        return await asyncio.to_thread(func, *args)
+    
+    def _merged_users(self) -> List[int]:
+        """Снимок с примененной дельтой, по возрастанию"""
+        # Снимок уже отсортирован - сливаем его с дельтой без построения множества
+        from_snapshot = (u for u in self.snapshot or () if u not in self.removed)
+        return list(heapq.merge(from_snapshot, sorted(self.added)))
+    
+    def _count_local(self) -> int:
+        return len(self.snapshot or ()) - len(self.removed) + len(self.added)
+    
+    def _contains(self, user_id: int) -> bool:
+        if user_id in self.added:
             return True
-        return False
+        if user_id in self.removed:
+            return False
+        return self.snapshot is not None and user_id in self.snapshot
+    
+    async def add_user(self, user_id: int, duration: Optional[float] = None) -> Optional[str]:
+        """Добавить пользователя в белый список (на duration секунд, если задано).
+        
+        Возвращает, что изменилось: 'added' - добавлен, 'made_permanent' -
+        временный доступ стал бессрочным, 'renewed' - назначен новый срок,
+        'already_permanent' - бессрочный доступ не превращается во временный,
+        None - пользователь уже в списке с тем же доступом.
+        """
+        expires_at = time.time() + duration if duration else None
+        current = await self.expiry_of(user_id)
+        
+        if self.store is not None:
+            added = await self._store_call(self.store.wl_add, user_id)
+        else:
+            added = self._mutate(lambda: self._add_local(user_id))
+        
+        if not added and expires_at is not None and current is None:
+            # Срок молча отнял бы бессрочный доступ
+            return 'already_permanent'
+        
+        changed = await self._set_expiry(user_id, expires_at)
+        if added:
+            logger.info(f"➕ Добавлен пользователь {user_id} в белый список")
+            return 'added'
+        if changed:
+            return 'made_permanent' if expires_at is None else 'renewed'
+        return None
+    
+    def _add_local(self, user_id: int) -> bool:
+        if self._contains(user_id):
+            return False
+        if user_id in self.removed:
+            self.removed.discard(user_id)
+        else:
+            self.added.add(user_id)
+        return True
+    
+    def _remove_local(self, user_ids: List[int]) -> List[int]:
+        removed = []
+        for user_id in user_ids:
+            if not self._contains(user_id):
+                continue
+            if user_id in self.added:
+                self.added.discard(user_id)
+            else:
+                self.removed.add(user_id)
+            removed.append(user_id)
+        return removed
     
-    def remove_user(self, user_id: int) -> bool:
+    async def remove_user(self, user_id: int) -> bool:
         """Удалить пользователя из белого списка"""
-        if user_id in self.allowed_users:
-            self.allowed_users.remove(user_id)
-            self.save()
+        return bool(await self.remove_users([user_id]))
+    
+    async def remove_users(self, user_ids: List[int]) -> List[int]:
+        """Удалить нескольких пользователей с одной записью на диск"""
+        if self.store is not None:
+            removed = [u for u in user_ids if await self._store_call(self.store.wl_remove, u)]
+        else:
+            removed = self._mutate(lambda: self._remove_local(user_ids))
+        
+        dropped = [u for u in user_ids if self.expirations.pop(u, None) is not None]
+        if self.store is not None:
+            # Срок могла назначить другая реплика, о которой здесь еще не знают
+            await self.save_expirations(user_ids)
+        elif dropped:
+            await self.save_expirations(dropped)
+        
+        for user_id in removed:
             logger.info(f"➖ Удален пользователь {user_id} из белого списка")
-            return True
-        return False
+        return removed
     
-    def get_all_users(self) -> List[int]:
+    async def get_all_users(self) -> List[int]:
         """Получить список всех пользователей"""
-        return sorted(list(self.allowed_users))
+        if self.store is not None:
+            return await self._store_call(self.store.wl_all)
+        
+        self._maybe_reload()
+        return self._merged_users()
+    
+    async def count(self) -> int:
+        """Количество пользователей в белом списке"""
+        if self.store is not None:
+            return len(await self._store_call(self.store.wl_all))
+        
+        self._maybe_reload()
+        return self._count_local()
     
-    def is_allowed(self, user_id: int) -> bool:
+    async def is_allowed(self, user_id: int) -> bool:
         """Проверить, есть ли пользователь в белом списке"""
-        result = user_id in self.allowed_users
+        if self.store is not None:
+            # Другие реплики могли изменить список - спрашиваем хранилище
+            result = await self._store_call(self.store.wl_contains, user_id)
+        else:
+            self._maybe_reload()
+            result = self._contains(user_id)
+        
+        # Планировщик мог еще не дойти до истекшего доступа
+        expires_at = self.expirations.get(user_id)
+        if result and expires_at is not None and expires_at <= time.time():
+            if self.store is not None:
+                # Срок могла продлить или снять другая реплика - решает хранилище
+                result = user_id not in await self.expire_due()
+            else:
+                result = False
         logger.info(f"🔍 Checking whitelist for {user_id}: {result}")
         return result
     
-    def clear_all(self):
+    async def clear_all(self):
         """Очистить весь белый список"""
-        self.allowed_users.clear()
-        self.save()
+        if self.store is not None:
+            await self._store_call(self.store.wl_clear)
+        else:
+            try:
+                with self._file_lock():
+                    self._replace_snapshot([])
+            except Exception as e:
+                logger.error(f"❌ Ошибка очистки белого списка: {e}")
+                raise WhitelistSaveError(str(e)) from e
+        self.expirations.clear()
+        self._expiry_heap.clear()
+        if self.store is None:
+            await self.save_expirations()
         logger.info("🧹 Белый список очищен")
+    
+    # ----- Временные доступы -----
+    
+    def load_expirations(self):
+        """Загрузить сроки временных доступов (при старте)"""
+        try:
+            if self.store is not None:
+                expirations = self.store.grants_all()
+            elif os.path.exists(self.grants_path):
+                with open(self.grants_path, 'r', encoding='utf-8') as f:
+                    expirations = {int(k): v for k, v in json.load(f).items()}
+            else:
+                expirations = {}
+        except Exception as e:
+            logger.error(f"❌ Ошибка загрузки временных доступов: {e}")
+            return
+        self._apply_expirations(expirations)
+    
+    def _apply_expirations(self, expirations: Dict[int, float]):
+        """Заменить сроки и перестроить кучу"""
+        self.expirations = expirations
+        self._expiry_heap = [(expires_at, user_id) for user_id, expires_at in self.expirations.items()]
+        heapq.heapify(self._expiry_heap)
+        self._expiry_changed.set()
+    
+    async def save_expirations(self, removed: Optional[List[int]] = None):
+        """Сохранить сроки временных доступов"""
+        try:
+            if self.store is not None:
+                await self._store_call(self.store.grant_remove, removed or [])
+                return
+            tmp_path = f"{self.grants_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({str(k): v for k, v in self.expirations.items()}, f)
+            os.replace(tmp_path, self.grants_path)
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения временных доступов: {e}")
+    
+    async def _set_expiry(self, user_id: int, expires_at: Optional[float]) -> bool:
+        """Назначить или снять срок доступа. True, если срок изменился"""
+        if expires_at is None:
+            had = self.expirations.pop(user_id, None) is not None
+            if self.store is not None:
+                # Срок могла назначить другая реплика - снимаем его в хранилище в любом случае
+                return bool(await self._store_call(self.store.grant_remove, [user_id])) or had
+            if had:
+                await self.save_expirations()
+            return had
+        
+        if self.expirations.get(user_id) == expires_at:
+            return False
+        
+        self.expirations[user_id] = expires_at
+        heapq.heappush(self._expiry_heap, (expires_at, user_id))
+        if self.store is not None:
+            await self._store_call(self.store.grant_set, user_id, expires_at)
+        else:
+            await self.save_expirations()
+        # Будим планировщик: новый срок может быть раньше текущего
+        self._expiry_changed.set()
+        return True
+    
+    async def expiry_of(self, user_id: int) -> Optional[float]:
+        """Срок доступа пользователя (None - бессрочный или не в списке)"""
+        if self.store is not None:
+            # Срок могла назначить другая реплика
+            return await self._store_call(self.store.grant_get, user_id)
+        return self.expirations.get(user_id)
+    
+    async def expires_in(self, user_id: int) -> Optional[float]:
+        """Сколько секунд осталось у временного доступа (None - бессрочный)"""
+        expires_at = await self.expiry_of(user_id)
+        if expires_at is None:
+            return None
+        return max(0.0, expires_at - time.time())
+    
+    async def all_expirations(self) -> Dict[int, float]:
+        """Сроки всех временных доступов (с хранилищем - актуальные, а не кэш)"""
+        if self.store is not None:
+            return await self._store_call(self.store.grants_all)
+        return dict(self.expirations)
+    
+    async def expire_due(self) -> List[int]:
+        """Снять все истекшие доступы одной пачкой"""
+        now = time.time()
+        due = []
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expires_at, user_id = heapq.heappop(self._expiry_heap)
+            # Запись устарела, если срок продлили или пользователя удалили
+            if self.expirations.get(user_id) == expires_at:
+                due.append(user_id)
+        
+        if not due:
+            return []
+        if self.store is not None:
+            removed = await self._expire_in_store(due)
+        else:
+            try:
+                removed = await self.remove_users(due)
+            except WhitelistSaveError:
+                # Вернем сроки в кучу, чтобы повторить на следующем проходе
+                for user_id in due:
+                    heapq.heappush(self._expiry_heap, (self.expirations[user_id], user_id))
+                raise
+        if self.audit is not None:
+            for user_id in removed:
+                self.audit.record('grant_expired', None, user_id)
+        if removed:
+            logger.info(f"⌛ Истек временный доступ: {len(removed)} пользователей")
+        return removed
+    
+    async def _expire_in_store(self, due: List[int]) -> List[int]:
+        """Снять истекшие доступы, только если в хранилище те же сроки"""
+        items = [(user_id, self.expirations.pop(user_id)) for user_id in due]
+        # Одна транзакция на всю пачку
+        removed = await self._store_call(self.store.grant_expire_many, items)
+        for user_id in removed:
+            logger.info(f"➖ Удален пользователь {user_id} из белого списка")
+        if len(removed) < len(items):
+            # Другая реплика продлила или сняла срок - берем актуальные сроки
+            self._apply_expirations(await self._store_call(self.store.grants_all))
+        return removed
+    
+    async def run_expiry_scheduler(self):
+        """Снимать временные доступы по мере истечения сроков"""
+        next_resync = time.monotonic() + self.EXPIRY_RESYNC_INTERVAL
+        while True:
+            self._expiry_changed.clear()
+            try:
+                # С общим хранилищем подхватываем сроки, назначенные другими репликами
+                if self.store is not None and time.monotonic() >= next_resync:
+                    self._apply_expirations(await self._store_call(self.store.grants_all))
+                    next_resync = time.monotonic() + self.EXPIRY_RESYNC_INTERVAL
+                await self.expire_due()
+            except Exception as e:
+                logger.error(f"❌ Ошибка планировщика доступов: {e}")
+            
+            # Спим до ближайшего срока, но не дольше интервала пересинхронизации
+            timeout = self.EXPIRY_RESYNC_INTERVAL
+            if self._expiry_heap:
+                timeout = min(timeout, max(0.0, self._expiry_heap[0][0] - time.time()))
+            try:
+                await asyncio.wait_for(self._expiry_changed.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+class FlowAbandoned(Exception):
+    """QR-поток оборвался, ждать дальше нет смысла"""
 
 class WorkingSessionManager:
-    def __init__(self, whitelist_manager: WhiteListManager):
+    # Причины досрочного завершения потока
+    END_REASONS = {
+        'cancelled': 'отмена',
+        'superseded': 'новый QR',
+        'disconnected': 'обрыв связи',
+        'drain': 'остановка реплики',
+    }
+    
+    def __init__(self, whitelist_manager: WhiteListManager, store: Optional[StateStore] = None):
         self.active_sessions = {}
         self.user_messages = {}
         self.whitelist = whitelist_manager
+        self.store = store
+        self.metrics = {
+            'flows': 0,
+            'connection_seconds': 0.0,
+            'connection_seconds_saved': 0.0,
+            'ended_early': {reason: 0 for reason in self.END_REASONS},
+        }
     
-    def has_access(self, user_id: int) -> bool:
+    async def has_access(self, user_id: int) -> bool:
         """Проверка доступа пользователя"""
         is_adm = is_admin(user_id)
-        is_wl = self.whitelist.is_allowed(user_id)
+        is_wl = await self.whitelist.is_allowed(user_id)
         has_access = is_adm or is_wl
         
         logger.info(f"🔐 Access check for {user_id}: admin={is_adm}, whitelist={is_wl}, access={has_access}")
@@ -191,15 +763,11 @@ class WorkingSessionManager:
         """Создание QR-сессии"""
         try:
             # Проверяем доступ
-            if not self.has_access(user_id):
+            if not await self.has_access(user_id):
                 return False, "❌ Доступ запрещен. Вы не в белом списке."
             
             # Закрываем старую сессию если есть
-            if user_id in self.active_sessions:
-                try:
-                    await self.active_sessions[user_id]['client'].disconnect()
-                except:
-                    pass
+            await self.cancel_session(user_id, 'superseded')
             
             # Используем разные API на случай если одно не работает
             api_configs = [
@@ -223,15 +791,26 @@ class WorkingSessionManager:
                     
                     qr_login = await client.qr_login()
                     
+                    # Сканировать QR после истечения токена бесполезно
+                    token_ttl = (qr_login.expires - datetime.now(tz=qr_login.expires.tzinfo)).total_seconds()
+                    now = time.monotonic()
                     self.active_sessions[user_id] = {
                         'client': client,
                         'qr_login': qr_login,
                         'created_at': datetime.now(),
-                        'message': message
+                        'message': message,
+                        'task': None,
+                        'started': now,
+                        'deadline': now + max(0.0, min(QR_WAIT_TIMEOUT, token_ttl)),
+                        'end_reason': None,
                     }
                     
                     self.user_messages[user_id] = message
                     
+                    # Отмечаем в общем хранилище, что клиент пользователя живет на этой реплике
+                    if self.store is not None:
+                        await asyncio.to_thread(self.store.claim_session, user_id, REPLICA_ID, SESSION_OWNER_TTL)
+                    
                     logger.info(f"✅ QR created with API {config['api_id']} for user {user_id}")
                     return True, qr_login.url
                     
@@ -247,6 +826,39 @@ class WorkingSessionManager:
             logger.error(f"QR creation error: {e}")
             return False, f"❌ Ошибка создания QR: {str(e)}"
     
+    def start_monitoring(self, user_id: int):
+        """Запустить мониторинг QR в фоне и запомнить задачу для отмены"""
+        data = self.active_sessions.get(user_id)
+        if data is None:
+            return
+        data['task'] = asyncio.create_task(self.start_qr_monitoring(user_id))
+    
+    def wait_seconds(self, user_id: int) -> int:
+        """Сколько секунд осталось ждать сканирования QR"""
+        data = self.active_sessions.get(user_id)
+        if data is None:
+            return 0
+        return int(max(0.0, data['deadline'] - time.monotonic()))
+    
+    async def wait_for_scan(self, data: dict):
+        """Ждать сканирования QR или окончательного обрыва соединения клиента"""
+        timeout = max(0.0, data['deadline'] - time.monotonic())
+        wait_task = asyncio.ensure_future(data['qr_login'].wait(timeout=timeout))
+        # Telethon сам переподключается при временных обрывах;
+        # disconnected завершается, только когда клиент сдался
+        disconnected = data['client'].disconnected
+        try:
+            await asyncio.wait({wait_task, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if wait_task.done():
+                return wait_task.result()
+            data['end_reason'] = 'disconnected'
+            raise FlowAbandoned('disconnected')
+        finally:
+            for future in (wait_task, disconnected):
+                if not future.done():
+                    future.cancel()
+            await asyncio.gather(wait_task, disconnected, return_exceptions=True)
+    
     async def start_qr_monitoring(self, user_id: int):
         """Запуск мониторинга статуса QR-авторизации"""
         if user_id not in self.active_sessions:
@@ -254,12 +866,13 @@ class WorkingSessionManager:
         
         data = self.active_sessions[user_id]
         message = data['message']
+        status_msg = None
         
         try:
             status_msg = await message.answer("⏳ Ожидаем сканирование QR-кода...")
             
-            # Ждем сканирования с таймаутом 120 секунд
-            await asyncio.wait_for(data['qr_login'].wait(), timeout=120)
+            # Ждем сканирования до истечения токена (не дольше 120 секунд)
+            await self.wait_for_scan(data)
             
             await status_msg.edit_text("✅ QR-код отсканирован! Проверяем авторизацию...")
             await asyncio.sleep(3)
@@ -282,11 +895,14 @@ class WorkingSessionManager:
             session_file = BufferedInputFile(session_bytes, filename="telegram_session.txt")
             
             # Отправляем сессию пользователю
-            await message.answer_document(
-                document=session_file,
-                caption="✅ **Сессия успешно создана!**\n\n"
-                       "💾 Сохраните этот файл\n"
-                       "🔒 Он дает полный доступ к аккаунту"
+            await bot(
+                message.answer_document(
+                    document=session_file,
+                    caption="✅ **Сессия успешно создана!**\n\n"
+                           "💾 Сохраните этот файл\n"
+                           "🔒 Он дает полный доступ к аккаунту"
+                ),
+                request_timeout=BOT_API_UPLOAD_TIMEOUT,
             )
             
             # Также отправляем текстовую версию
@@ -294,6 +910,20 @@ class WorkingSessionManager:
             
             logger.info(f"🎉 Сессия отправлена пользователю {user_id}")
             
+        except asyncio.CancelledError:
+            # Отмена пользователем, новый QR или остановка реплики
+            if status_msg is not None:
+                try:
+                    await status_msg.edit_text("❌ Создание сессии отменено")
+                except Exception:
+                    pass
+            raise
+        except FlowAbandoned:
+            if status_msg is not None:
+                await status_msg.edit_text(
+                    "❌ Соединение с Telegram потеряно, создание сессии остановлено.\n"
+                    "🔄 Нажмите /start, чтобы начать заново."
+                )
         except asyncio.TimeoutError:
             if user_id in self.user_messages:
                 await self.user_messages[user_id].answer("❌ Время ожидания истекло. QR-код не был отсканирован.")
@@ -303,23 +933,269 @@ class WorkingSessionManager:
                 await self.user_messages[user_id].answer(f"❌ Ошибка: {str(e)}")
         finally:
             # Всегда очищаем сессию
-            await self.cleanup_session(user_id)
+            await self.cleanup_session(user_id, data)
     
-    async def cleanup_session(self, user_id: int):
+    async def cancel_session(self, user_id: int, reason: str) -> bool:
+        """Досрочно завершить QR-поток и сразу освободить клиент"""
+        data = self.active_sessions.get(user_id)
+        if data is None:
+            return False
+        
+        data['end_reason'] = reason
+        task = data.get('task')
+        if task is not None and not task.done() and task is not asyncio.current_task():
+            # Задача сама очистит сессию в finally
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        else:
+            await self.cleanup_session(user_id, data)
+        return True
+    
+    async def cleanup_session(self, user_id: int, data: Optional[dict] = None):
         """Очистка сессии"""
-        if user_id in self.active_sessions:
-            try:
-                await self.active_sessions[user_id]['client'].disconnect()
-            except:
-                pass
-            del self.active_sessions[user_id]
+        current = self.active_sessions.get(user_id)
+        # Старая задача не должна удалить уже созданную новую сессию
+        if current is None or (data is not None and current is not data):
+            return
+        
+        try:
+            await current['client'].disconnect()
+        except:
+            pass
+        del self.active_sessions[user_id]
+        self.record_flow_end(user_id, current)
         
         if user_id in self.user_messages:
             del self.user_messages[user_id]
+        
+        if self.store is not None:
+            try:
+                await asyncio.to_thread(self.store.release_session, user_id, REPLICA_ID)
+            except StateStoreError as e:
+                logger.error(f"❌ Не удалось снять владение сессией {user_id}: {e}")
+    
+    def record_flow_end(self, user_id: int, data: dict):
+        """Учесть время удержания соединения и сэкономленное досрочным завершением"""
+        now = time.monotonic()
+        self.metrics['flows'] += 1
+        self.metrics['connection_seconds'] += now - data['started']
+        
+        reason = data.get('end_reason')
+        if reason in self.END_REASONS:
+            saved = max(0.0, data['deadline'] - now)
+            self.metrics['ended_early'][reason] += 1
+            self.metrics['connection_seconds_saved'] += saved
+            logger.info(f"🛑 QR-поток {user_id} завершен досрочно ({reason}), сэкономлено {saved:.0f} сек соединения")
+
+class ReplicaCoordinator:
+    """Координация реплик через общее хранилище.
+
+    Апдейты из Telegram получает только лидер (getUpdates нельзя вызывать
+    из нескольких процессов). Лидер отправляет апдейт той реплике, где живет
+    Telethon-клиент пользователя, а новых пользователей распределяет по
+    живым репликам по user_id. Остальные реплики читают свою очередь.
+    """
+    
+    LEADER_LOCK = "polling"
+    
+    def __init__(self, store: StateStore, replica_id: str, session_manager: WorkingSessionManager):
+        self.store = store
+        self.replica_id = replica_id
+        self.sessions = session_manager
+        self.is_leader = False
+        self.draining = False
+        self._stopped = asyncio.Event()
+        self._tasks: Set[asyncio.Task] = set()
+    
+    def route(self, user_id: int) -> str:
+        """Выбрать реплику для апдейта пользователя"""
+        if user_id in self.sessions.active_sessions:
+            return self.replica_id
+        
+        owner = self.store.session_owner(user_id)
+        if owner and owner in self.store.live_replicas(include_draining=True):
+            return owner
+        
+        live = self.store.live_replicas()
+        if not live:
+            return self.replica_id
+        return live[user_id % len(live)]
+    
+    async def forward(self, replica_id: str, update: Update):
+        """Переслать апдейт в очередь другой реплики"""
+        payload = update.model_dump_json(exclude_unset=True)
+        await asyncio.to_thread(self.store.push_update, replica_id, payload)
+        logger.info(f"📨 Update {update.update_id} переслан реплике {replica_id}")
+    
+    async def heartbeat_loop(self):
+        """Продление регистрации реплики и блокировки лидера"""
+        while not self._stopped.is_set():
+            try:
+                await asyncio.to_thread(self.store.heartbeat, self.replica_id, REPLICA_TTL, self.draining)
+                if not self.draining:
+                    was_leader = self.is_leader
+                    self.is_leader = await asyncio.to_thread(
+                        self.store.acquire_lock, self.LEADER_LOCK, self.replica_id, REPLICA_TTL
+                    )
+                    if self.is_leader and not was_leader:
+                        logger.info(f"👑 Реплика {self.replica_id} стала лидером")
+                    elif was_leader and not self.is_leader:
+                        logger.warning(f"⚠️ Реплика {self.replica_id} потеряла лидерство")
+            except StateStoreError as e:
+                logger.error(f"❌ Ошибка heartbeat: {e}")
+                self.is_leader = False
+            
+            try:
+                await asyncio.wait_for(self._stopped.wait(), timeout=HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def inbox_loop(self, dispatcher: Dispatcher, bot: Bot):
+        """Обработка апдейтов, пересланных другими репликами"""
+        while not self._stopped.is_set():
+            try:
+                payloads = await asyncio.to_thread(self.store.pop_updates, self.replica_id)
+            except StateStoreError as e:
+                logger.error(f"❌ Ошибка чтения очереди: {e}")
+                payloads = []
+            
+            for payload in payloads:
+                try:
+                    update = Update.model_validate_json(payload, context={"bot": bot})
+                except Exception as e:
+                    # Битый апдейт или апдейт от реплики другой версии не должен останавливать очередь
+                    logger.error(f"❌ Не удалось разобрать пересланный апдейт: {e}")
+                    continue
+                task = asyncio.create_task(dispatcher.feed_update(bot, update, forwarded=True))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            
+            if not payloads:
+                await asyncio.sleep(0.2)
+    
+    async def polling_loop(self, dispatcher: Dispatcher, bot: Bot):
+        """Получение апдейтов из Telegram, пока реплика - лидер"""
+        while not self._stopped.is_set():
+            if not self.is_leader or self.draining:
+                await asyncio.sleep(0.5)
+                continue
+            
+            polling = asyncio.create_task(
+                dispatcher.start_polling(bot, handle_signals=False, close_bot_session=False)
+            )
+            while self.is_leader and not self.draining and not polling.done():
+                await asyncio.sleep(0.5)
+            
+            cancelled = False
+            if not polling.done():
+                try:
+                    await dispatcher.stop_polling()
+                except RuntimeError:
+                    # Polling еще не успел запуститься
+                    polling.cancel()
+                    cancelled = True
+            try:
+                await polling
+            except asyncio.CancelledError:
+                if not cancelled:
+                    raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка polling: {e}")
+                await asyncio.sleep(HEARTBEAT_INTERVAL)
+    
+    def request_drain(self):
+        """Начать дренаж по сигналу остановки"""
+        if self.draining:
+            return
+        logger.info(f"🛑 Реплика {self.replica_id} начинает дренаж")
+        self.draining = True
+        self.is_leader = False
+    
+    async def drain(self):
+        """Передать работу другим репликам и дождаться активных сессий"""
+        try:
+            await asyncio.to_thread(self.store.release_lock, self.LEADER_LOCK, self.replica_id)
+            await asyncio.to_thread(self.store.heartbeat, self.replica_id, REPLICA_TTL, True)
+        except StateStoreError as e:
+            logger.error(f"❌ Ошибка при дренаже: {e}")
+        
+        # Новые пользователи уже идут на другие реплики, а апдейты
+        # текущих сессий продолжают приходить сюда через очередь
+        deadline = asyncio.get_running_loop().time() + DRAIN_TIMEOUT
+        while self.sessions.active_sessions and asyncio.get_running_loop().time() < deadline:
+            logger.info(f"⏳ Дренаж: осталось {len(self.sessions.active_sessions)} активных сессий")
+            await asyncio.sleep(1)
+        
+        for user_id in list(self.sessions.active_sessions):
+            await self.sessions.cancel_session(user_id, 'drain')
+        
+        self._stopped.set()
+        try:
+            await asyncio.to_thread(self.store.remove_replica, self.replica_id)
+        except StateStoreError as e:
+            logger.error(f"❌ Ошибка при снятии регистрации: {e}")
+        logger.info(f"👋 Реплика {self.replica_id} завершила дренаж")
+    
+    async def run(self, dispatcher: Dispatcher, bot: Bot):
+        """Запуск реплики до завершения дренажа"""
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.request_drain)
+            except (NotImplementedError, RuntimeError):
+                pass
+        
+        workers = [
+            asyncio.create_task(self.heartbeat_loop()),
+            asyncio.create_task(self.inbox_loop(dispatcher, bot)),
+            asyncio.create_task(self.polling_loop(dispatcher, bot)),
+        ]
+        try:
+            while not self.draining:
+                await asyncio.sleep(0.5)
+            await self.drain()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await bot.session.close()
+
+class ReplicaRoutingMiddleware(BaseMiddleware):
+    """Отправляет апдейт реплике, которая держит клиент пользователя"""
+    
+    def __init__(self, coordinator: ReplicaCoordinator):
+        self.coordinator = coordinator
+    
+    async def __call__(self, handler, event: Update, data: dict):
+        user = data.get('event_from_user')
+        if data.get('forwarded') or user is None:
+            return await handler(event, data)
+        
+        try:
+            target = await asyncio.to_thread(self.coordinator.route, user.id)
+        except StateStoreError as e:
+            logger.error(f"❌ Ошибка маршрутизации для {user.id}: {e}")
+            target = self.coordinator.replica_id
+        
+        if target == self.coordinator.replica_id:
+            return await handler(event, data)
+        
+        await self.coordinator.forward(target, event)
+        return None
 
 # Инициализация менеджеров
-whitelist_manager = WhiteListManager()
-manager = WorkingSessionManager(whitelist_manager)
+try:
+    whitelist_manager = WhiteListManager(store=state_store, audit=audit_log)
+except SnapshotError as e:
+    print(f"❌ Whitelist snapshot is corrupt: {e}")
+    print("   Restore it from a backup or delete it to start with an empty whitelist")
+    exit(1)
+manager = WorkingSessionManager(whitelist_manager, store=state_store)
+coordinator = None
+
+if state_store is not None:
+    coordinator = ReplicaCoordinator(state_store, REPLICA_ID, manager)
+    dp.update.outer_middleware(ReplicaRoutingMiddleware(coordinator))
 
 # ==============================================
 # КОМАНДЫ ДЛЯ ВСЕХ ПОЛЬЗОВАТЕЛЕЙ
@@ -330,7 +1206,8 @@ async def cmd_start(message: Message):
     user_id = message.from_user.id
     
     # Проверка доступа
-    if not manager.has_access(user_id):
+    if not await manager.has_access(user_id):
+        audit_log.record('access_denied', user_id, command='/start')
         await message.answer(
             "❌ **Доступ запрещен**\n\n"
             "Вы не находитесь в белом списке пользователей.\n"
@@ -365,7 +1242,8 @@ async def cmd_qr(message: Message):
     """Команда /qr - показывает кнопку для создания сессии"""
     user_id = message.from_user.id
     
-    if not manager.has_access(user_id):
+    if not await manager.has_access(user_id):
+        audit_log.record('access_denied', user_id, command='/qr')
         await message.answer("❌ **Доступ запрещен**\n\nВы не находитесь в белом списке.")
         return
     
@@ -385,7 +1263,8 @@ async def handle_qr_method(callback: CallbackQuery):
     user_id = callback.from_user.id
     
     # Проверка доступа
-    if not manager.has_access(user_id):
+    if not await manager.has_access(user_id):
+        audit_log.record('access_denied', user_id, command='method_qr')
         await callback.answer("❌ Доступ запрещен!", show_alert=True)
         return
     
@@ -407,29 +1286,55 @@ async def handle_qr_method(callback: CallbackQuery):
         
         qr_file = BufferedInputFile(bio.getvalue(), filename="qr_code.png")
         
-        await callback.message.answer_photo(
-            photo=qr_file,
-            caption="📷 **QR-код для подключения:**\n\n"
-                   "1. Откройте Telegram → Настройки\n"
-                   "2. Устройства → Подключить устройство\n"
-                   "3. Отсканируйте этот QR-код\n"
-                   "4. **Подтвердите вход** в приложении\n\n"
-                   "⏳ Ожидаем 2 минуты...\n"
-                   "✅ Сессия придет автоматически после подключения"
+        builder = InlineKeyboardBuilder()
+        builder.button(text="❌ Отменить", callback_data="cancel_qr")
+        
+        await bot(
+            callback.message.answer_photo(
+                photo=qr_file,
+                caption="📷 **QR-код для подключения:**\n\n"
+                       "1. Откройте Telegram → Настройки\n"
+                       "2. Устройства → Подключить устройство\n"
+                       "3. Отсканируйте этот QR-код\n"
+                       "4. **Подтвердите вход** в приложении\n\n"
+                       f"⏳ QR-код действует {manager.wait_seconds(user_id)} сек\n"
+                       "✅ Сессия придет автоматически после подключения",
+                reply_markup=builder.as_markup()
+            ),
+            request_timeout=BOT_API_UPLOAD_TIMEOUT,
         )
         
         # Запускаем мониторинг
-        asyncio.create_task(manager.start_qr_monitoring(user_id))
+        manager.start_monitoring(user_id)
         
     else:
         await callback.message.edit_text(f"❌ {qr_url}")
 
+@router.callback_query(F.data == "cancel_qr")
+async def handle_cancel_qr(callback: CallbackQuery):
+    """Отмена QR-потока кнопкой под QR-кодом"""
+    user_id = callback.from_user.id
+    
+    cancelled = await manager.cancel_session(user_id, 'cancelled')
+    await callback.answer("❌ Отменено" if cancelled else "Нет активной сессии")
+    
+    # QR-код больше не действует - убираем его (или хотя бы кнопку)
+    try:
+        await callback.message.delete()
+    except TelegramAPIError:
+        try:
+            await callback.message.edit_reply_markup(reply_markup=None)
+        except TelegramAPIError as e:
+            # Сообщение слишком старое или уже изменено - поток все равно отменен
+            logger.info(f"ℹ️ QR-сообщение {user_id} не удалось убрать: {e}")
+
 @router.callback_query(F.data == "admin_panel")
 async def handle_admin_panel(callback: CallbackQuery):
     """Обработка нажатия кнопки админ панели"""
     user_id = callback.from_user.id
     
     if not is_admin(user_id):
+        audit_log.record('access_denied', user_id, command='admin_panel')
         await callback.answer("❌ Нет доступа!", show_alert=True)
         return
     
@@ -440,14 +1345,16 @@ async def handle_admin_panel(callback: CallbackQuery):
         f"🆔 **Ваш ID:** `{user_id}`\n"
         f"📊 **Всего админов:** {len(ADMIN_IDS)}\n\n"
         f"📋 **Команды:**\n"
-        f"/add_user [ID] - добавить пользователя\n"
+        f"/add_user [ID] [срок] - добавить пользователя\n"
         f"/remove_user [ID] - удалить пользователя\n"
         f"/list_users - показать всех пользователей\n"
         f"/clear_users - очистить весь список\n"
         f"/stats - статистика\n"
+        f"/audit - журнал действий\n"
         f"/debug - отладочная информация\n\n"
         f"Пример:\n"
         f"`/add_user 123456789`\n"
+        f"`/add_user 123456789 7d` - доступ на 7 дней\n"
         f"`/remove_user 123456789`"
     )
     
@@ -458,7 +1365,8 @@ async def cmd_check(message: Message):
     """Проверка статуса сессии"""
     user_id = message.from_user.id
     
-    if not manager.has_access(user_id):
+    if not await manager.has_access(user_id):
+        audit_log.record('access_denied', user_id, command='/check')
         await message.answer("❌ **Доступ запрещен**")
         return
     
@@ -482,7 +1390,8 @@ async def cmd_help(message: Message):
         "/start - показать меню\n"
         "/check - проверить статус\n"
         "/help - эта справка\n"
-        "/myid - показать мой ID\n\n"
+        "/myid - показать мой ID\n"
+        "/cancel - отменить создание сессии\n\n"
         "⚠️ **Важно:** После сканирования нажмите 'Подключить' в Telegram!"
     )
     await message.answer(help_text)
@@ -496,8 +1405,14 @@ async def cmd_myid(message: Message):
     last_name = message.from_user.last_name or ""
     
     admin_status = is_admin(user_id)
-    whitelist_status = whitelist_manager.is_allowed(user_id)
-    has_access = manager.has_access(user_id)
+    whitelist_status = await whitelist_manager.is_allowed(user_id)
+    has_access = await manager.has_access(user_id)
+    expires_in = await whitelist_manager.expires_in(user_id) if whitelist_status else None
+    
+    if expires_in is not None:
+        whitelist_line = f"✅ ДА (еще {format_remaining(expires_in)})"
+    else:
+        whitelist_line = '✅ ДА' if whitelist_status else '❌ НЕТ'
     
     text = (
         f"👤 **Ваши данные:**\n"
@@ -505,7 +1420,7 @@ async def cmd_myid(message: Message):
         f"📛 **Имя:** {first_name} {last_name}\n"
         f"🔗 **Username:** @{username}\n"
         f"👑 **Статус админа:** {'✅ ДА' if admin_status else '❌ НЕТ'}\n"
-        f"📋 **В белом списке:** {'✅ ДА' if whitelist_status else '❌ НЕТ'}\n"
+        f"📋 **В белом списке:** {whitelist_line}\n"
         f"🔐 **Есть доступ к QR:** {'✅ ДА' if has_access else '❌ НЕТ'}\n\n"
         f"📊 **Admin IDs в системе:** {sorted(list(ADMIN_IDS))}"
     )
@@ -522,6 +1437,7 @@ async def cmd_admin(message: Message):
     user_id = message.from_user.id
     
     if not is_admin(user_id):
+        audit_log.record('access_denied', user_id, command='/admin')
         await message.answer(f"❌ Нет доступа к админ панели\nВаш ID: {user_id}")
         return
     
@@ -531,14 +1447,16 @@ async def cmd_admin(message: Message):
         f"📊 **Всего админов:** {len(ADMIN_IDS)}\n\n"
         f"📋 **Команды:**\n"
         f"/myid - показать мой ID\n"
-        f"/add_user [ID] - добавить пользователя\n"
+        f"/add_user [ID] [срок] - добавить пользователя\n"
         f"/remove_user [ID] - удалить пользователя\n"
         f"/list_users - показать всех пользователей\n"
         f"/clear_users - очистить весь список\n"
         f"/stats - статистика\n"
+        f"/audit - журнал действий\n"
         f"/debug - отладочная информация\n\n"
         f"Пример:\n"
         f"`/add_user 123456789`\n"
+        f"`/add_user 123456789 7d` - доступ на 7 дней\n"
         f"`/remove_user 123456789`"
     )
     
@@ -550,24 +1468,65 @@ async def cmd_add_user(message: Message):
     user_id = message.from_user.id
     
     if not is_admin(user_id):
+        audit_log.record('access_denied', user_id, command='/add_user')
         await message.answer("❌ Нет доступа")
         return
     
     args = message.text.split()
     
     if len(args) < 2:
-        await message.answer("❌ Укажите ID пользователя\nПример: `/add_user 123456789`")
+        await message.answer(
+            "❌ Укажите ID пользователя\n"
+            "Пример: `/add_user 123456789`\n"
+            "Временный доступ: `/add_user 123456789 7d` (s, m, h, d, w)"
+        )
         return
     
+    duration = None
+    if len(args) >= 3:
+        duration = parse_duration(args[2])
+        if duration is None:
+            await message.answer("❌ Неверный срок. Примеры: `30m`, `12h`, `7d`, `1d12h`")
+            return
+    
     try:
         user_to_add = int(args[1])
         
         if user_to_add in ADMIN_IDS:
             await message.answer("❌ Нельзя добавить администратора")
-        elif whitelist_manager.add_user(user_to_add):
-            await message.answer(f"✅ Пользователь `{user_to_add}` добавлен в белый список")
-        else:
+            return
+        
+        try:
+            result = await whitelist_manager.add_user(user_to_add, duration)
+        except (WhitelistSaveError, StateStoreError) as e:
+            await message.answer(f"❌ Изменение не сохранено: {e}")
+            return
+        
+        if result == 'already_permanent':
+            await message.answer(
+                f"ℹ️ Пользователь `{user_to_add}` уже в белом списке бессрочно, срок не назначен\n"
+                f"Чтобы выдать временный доступ, сначала `/remove_user {user_to_add}`"
+            )
+            return
+        if result is None:
             await message.answer(f"ℹ️ Пользователь `{user_to_add}` уже в белом списке")
+            return
+        
+        audit_log.record('add_user', user_id, user_to_add, duration=duration, change=result)
+        if result == 'made_permanent':
+            await message.answer(f"✅ Временный доступ `{user_to_add}` заменен бессрочным")
+        elif result == 'renewed':
+            await message.answer(
+                f"✅ Новый срок доступа `{user_to_add}`: {format_remaining(duration)} "
+                f"(прежний срок заменен)"
+            )
+        elif duration:
+            await message.answer(
+                f"✅ Пользователь `{user_to_add}` добавлен в белый список "
+                f"на {format_remaining(duration)}"
+            )
+        else:
+            await message.answer(f"✅ Пользователь `{user_to_add}` добавлен в белый список")
             
     except ValueError:
         await message.answer("❌ Неверный формат ID. Используйте числовой ID")
@@ -578,6 +1537,7 @@ async def cmd_remove_user(message: Message):
     user_id = message.from_user.id
     
     if not is_admin(user_id):
+        audit_log.record('access_denied', user_id, command='/remove_user')
         await message.answer("❌ Нет доступа")
         return
     
@@ -590,7 +1550,14 @@ async def cmd_remove_user(message: Message):
     try:
         user_to_remove = int(args[1])
         
-        if whitelist_manager.remove_user(user_to_remove):
+        try:
+            removed = await whitelist_manager.remove_user(user_to_remove)
+        except (WhitelistSaveError, StateStoreError) as e:
+            await message.answer(f"❌ Изменение не сохранено: {e}")
+            return
+        
+        if removed:
+            audit_log.record('remove_user', user_id, user_to_remove)
             await message.answer(f"✅ Пользователь `{user_to_remove}` удален из белого списка")
         else:
             await message.answer(f"❌ Пользователь `{user_to_remove}` не найден в белом списке")
@@ -604,17 +1571,24 @@ async def cmd_list_users(message: Message):
     user_id = message.from_user.id
     
     if not is_admin(user_id):
+        audit_log.record('access_denied', user_id, command='/list_users')
         await message.answer("❌ Нет доступа")
         return
     
-    users = whitelist_manager.get_all_users()
+    users = await whitelist_manager.get_all_users()
     
     if not users:
         text = "📭 **Белый список пуст**\n\nНет пользователей в белом списке"
     else:
         text = f"👥 **Пользователи в белом списке** ({len(users)}):\n\n"
+        expirations = await whitelist_manager.all_expirations()
+        now = time.time()
         for i, user_id in enumerate(users, 1):
-            text += f"{i}. `{user_id}`\n"
+            expires_at = expirations.get(user_id)
+            if expires_at is not None:
+                text += f"{i}. `{user_id}` ⏳ {format_remaining(max(0.0, expires_at - now))}\n"
+            else:
+                text += f"{i}. `{user_id}`\n"
     
     await message.answer(text)
 
@@ -624,6 +1598,7 @@ async def cmd_clear_users(message: Message):
     user_id = message.from_user.id
     
     if not is_admin(user_id):
+        audit_log.record('access_denied', user_id, command='/clear_users')
         await message.answer("❌ Нет доступа")
         return
     
@@ -641,10 +1616,17 @@ async def cmd_confirm_clear(message: Message):
     user_id = message.from_user.id
     
     if not is_admin(user_id):
+        audit_log.record('access_denied', user_id, command='/confirm_clear')
         await message.answer("❌ Нет доступа")
         return
     
-    whitelist_manager.clear_all()
+    cleared = await whitelist_manager.count()
+    try:
+        await whitelist_manager.clear_all()
+    except (WhitelistSaveError, StateStoreError) as e:
+        await message.answer(f"❌ Белый список не очищен: {e}")
+        return
+    audit_log.record('clear_users', user_id, count=cleared)
     await message.answer("✅ Белый список очищен!")
 
 @router.message(Command("stats"))
@@ -653,29 +1635,133 @@ async def cmd_stats(message: Message):
     user_id = message.from_user.id
     
     if not is_admin(user_id):
+        audit_log.record('access_denied', user_id, command='/stats')
         await message.answer("❌ Нет доступа")
         return
     
-    users = whitelist_manager.get_all_users()
+    users_count = await whitelist_manager.count()
+    pending_grants = len(await whitelist_manager.all_expirations())
     active_sessions = len(manager.active_sessions)
+    whitelist_source = STATE_BACKEND if whitelist_manager.store is not None else whitelist_manager.snapshot_path
+    flow_metrics = manager.metrics
+    ended_early = ', '.join(
+        f"{label}: {flow_metrics['ended_early'][reason]}"
+        for reason, label in manager.END_REASONS.items()
+    )
     
     stats_text = (
         f"📊 **Статистика системы**\n\n"
-        f"👥 Пользователей в белом списке: {len(users)}\n"
+        f"👥 Пользователей в белом списке: {users_count}\n"
+        f"⏳ Временных доступов: {pending_grants}\n"
         f"🔄 Активных сессий: {active_sessions}\n"
+        f"📷 Завершено QR-потоков: {flow_metrics['flows']}\n"
+        f"🛑 Досрочно: {ended_early}\n"
+        f"🔌 Соединение-секунд: удержано {flow_metrics['connection_seconds']:.0f}, "
+        f"сэкономлено {flow_metrics['connection_seconds_saved']:.0f}\n"
         f"👑 Админов: {len(ADMIN_IDS)}\n"
         f"🔧 API ID: `{API_ID}`\n"
-        f"📁 Файл белого списка: `{whitelist_manager.filename}`"
+        f"📁 Файл белого списка: `{whitelist_source}`"
     )
     
     await message.answer(stats_text)
 
+def parse_audit_time(value: str) -> Optional[float]:
+    """Время для /audit: дата 2026-10-01, дата и время 2026-10-01T12:00 или срок назад (24h)"""
+    seconds = parse_duration(value)
+    if seconds is not None:
+        return time.time() - seconds
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+def format_audit_entry(entry: dict) -> str:
+    """Одна строка журнала для вывода в чат"""
+    when = datetime.fromtimestamp(entry.get('ts', 0)).strftime('%Y-%m-%d %H:%M:%S')
+    text = f"`{when}` {entry.get('action')}"
+    if entry.get('actor') is not None:
+        text += f" от `{entry['actor']}`"
+    if entry.get('target') is not None:
+        text += f" → `{entry['target']}`"
+    if entry.get('command'):
+        text += f" ({entry['command']})"
+    if entry.get('duration'):
+        text += f" на {format_remaining(entry['duration'])}"
+    if entry.get('change') == 'made_permanent':
+        text += " (срок снят)"
+    elif entry.get('change') == 'renewed':
+        text += " (новый срок)"
+    if entry.get('count') is not None:
+        text += f" ({entry['count']} польз.)"
+    return text
+
+@router.message(Command("audit"))
+async def cmd_audit(message: Message):
+    """Журнал действий с фильтрами и страницами"""
+    user_id = message.from_user.id
+    
+    if not is_admin(user_id):
+        audit_log.record('access_denied', user_id, command='/audit')
+        await message.answer("❌ Нет доступа")
+        return
+    
+    usage = (
+        "❌ Неверный фильтр\n"
+        "Пример: `/audit user=123456789 action=add_user since=24h until=2026-10-01 page=2`"
+    )
+    filters = {}
+    for arg in message.text.split()[1:]:
+        key, _, value = arg.partition('=')
+        if key not in ('user', 'action', 'since', 'until', 'page') or not value:
+            await message.answer(usage)
+            return
+        filters[key] = value
+    
+    try:
+        filter_user = int(filters['user']) if 'user' in filters else None
+        page = max(1, int(filters.get('page', 1)))
+    except ValueError:
+        await message.answer(usage)
+        return
+    
+    since = until = None
+    if 'since' in filters:
+        since = parse_audit_time(filters['since'])
+    if 'until' in filters:
+        until = parse_audit_time(filters['until'])
+    if ('since' in filters and since is None) or ('until' in filters and until is None):
+        await message.answer(usage)
+        return
+    
+    # Свежие записи еще могут быть в буфере
+    await audit_log.flush()
+    entries, total = await asyncio.to_thread(
+        audit_log.query,
+        user_id=filter_user,
+        action=filters.get('action'),
+        since=since,
+        until=until,
+        offset=(page - 1) * AUDIT_PAGE_SIZE,
+        limit=AUDIT_PAGE_SIZE,
+    )
+    
+    if not entries:
+        await message.answer("📭 **Записей не найдено**")
+        return
+    
+    pages = (total + AUDIT_PAGE_SIZE - 1) // AUDIT_PAGE_SIZE
+    text = f"📜 **Журнал действий** (стр. {page}/{pages}, всего {total}):\n\n"
+    text += "\n".join(format_audit_entry(entry) for entry in entries)
+    
+    await message.answer(text)
+
 @router.message(Command("debug"))
 async def cmd_debug(message: Message):
     """Отладочная информация"""
     user_id = message.from_user.id
     
     if not is_admin(user_id):
+        audit_log.record('access_denied', user_id, command='/debug')
         await message.answer("❌ Нет доступа")
         return
     
@@ -695,16 +1781,19 @@ async def cmd_debug(message: Message):
     text += f"\n👑 **Admin IDs:** {sorted(list(ADMIN_IDS))}\n"
     text += f"👤 **Your ID:** {user_id}\n"
     text += f"🔍 **Is admin:** {is_admin(user_id)}\n"
-    text += f"📋 **In whitelist:** {whitelist_manager.is_allowed(user_id)}\n"
-    text += f"🔐 **Has access:** {manager.has_access(user_id)}"
+    text += f"📋 **In whitelist:** {await whitelist_manager.is_allowed(user_id)}\n"
+    text += f"🔐 **Has access:** {await manager.has_access(user_id)}"
     
     await message.answer(text)
 
 @router.message(Command("cancel"))
 async def cmd_cancel(message: Message, state: FSMContext):
     """Отмена текущего действия"""
+    # Сразу освобождаем Telethon-клиент, если ждем сканирования QR
+    cancelled_flow = await manager.cancel_session(message.from_user.id, 'cancelled')
+    
     current_state = await state.get_state()
-    if current_state is None:
+    if current_state is None and not cancelled_flow:
         return
     
     await state.clear()
@@ -714,8 +1803,21 @@ async def main():
     logger.info("🚀 Starting Working QR Session Bot...")
     logger.info(f"👑 Admin IDs: {sorted(list(ADMIN_IDS))}")
     logger.info(f"🔧 Using API_ID: {API_ID}")
-    logger.info(f"👥 Users in whitelist: {len(whitelist_manager.get_all_users())}")
-    await dp.start_polling(bot)
+    logger.info(f"👥 Users in whitelist: {await whitelist_manager.count()}")
+    
+    expiry_task = asyncio.create_task(whitelist_manager.run_expiry_scheduler())
+    audit_task = asyncio.create_task(audit_log.run())
+    
+    try:
+        if coordinator is not None:
+            await coordinator.run(dp, bot)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        expiry_task.cancel()
+        audit_task.cancel()
+        # Дописываем накопленные записи журнала перед выходом
+        await asyncio.gather(audit_task, return_exceptions=True)
 
 if __name__ == "__main__":
     asyncio.run(main())
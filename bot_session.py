@@ -0,0 +1,43 @@
+from typing import Optional
+
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+
+class TunedAiohttpSession(AiohttpSession):
+    """Сессия aiohttp с настраиваемым пулом соединений и keep-alive"""
+
+    def __init__(self, limit_per_host: int = 0, keepalive_timeout: float = 60,
+                 reuse_connections: bool = True, **kwargs):
+        super().__init__(**kwargs)
+        self._connector_init['limit_per_host'] = limit_per_host
+        if reuse_connections:
+            self._connector_init['keepalive_timeout'] = keepalive_timeout
+        else:
+            # aiohttp не допускает keepalive_timeout вместе с force_close
+            self._connector_init['force_close'] = True
+
+
+def create_bot_session(api_url: Optional[str] = None, is_local: bool = False,
+                       pool_limit: int = 100, pool_per_host: int = 0,
+                       keepalive_timeout: float = 60, reuse_connections: bool = True,
+                       timeout: float = 60) -> AiohttpSession:
+    """HTTP-сессия бота.
+
+    api_url - адрес своего сервера telegram-bot-api вместо api.telegram.org,
+    is_local - сервер запущен с --local (файлы отдаются по пути на диске).
+    timeout - таймаут запроса по умолчанию, отдельные запросы могут
+    передать свой request_timeout.
+    """
+    kwargs = {}
+    if api_url:
+        kwargs['api'] = TelegramAPIServer.from_base(api_url, is_local=is_local)
+
+    return TunedAiohttpSession(
+        limit=pool_limit,
+        limit_per_host=pool_per_host,
+        keepalive_timeout=keepalive_timeout,
+        reuse_connections=reuse_connections,
+        timeout=timeout,
+        **kwargs,
+    )
@@ -0,0 +1,135 @@
+"""Проверка журнала аудита: ротация, архивы, постраничный поиск и повтор записи.
+
+Запуск: python check_audit_log.py
+
+Все проверки идут во временном каталоге, настоящий журнал не трогается.
+"""
+import os
+import sys
+import asyncio
+import tempfile
+
+from audit_log import AuditLog
+
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+
+async def write(log: AuditLog, actors):
+    """Записать по одной записи на каждого actor, каждую отдельной пачкой"""
+    for actor in actors:
+        log.record('add_user', actor, actor + 1000)
+        await log.flush()
+
+
+async def check_rotation(tmp: str):
+    path = os.path.join(tmp, "rotation", "audit.log")
+    os.makedirs(os.path.dirname(path))
+    log = AuditLog(path, max_bytes=200, backups=3)
+
+    await write(log, range(2))
+    check(not os.path.exists(f"{path}.1.gz"), "до max_bytes файл не ротируется")
+    await write(log, range(2, 60))
+    check(os.path.exists(f"{path}.1.gz"), "при превышении max_bytes файл сжимается в .1.gz")
+    check(not os.path.exists(path) or os.path.getsize(path) < 200, "живой файл не больше max_bytes")
+
+    archives = sorted(name for name in os.listdir(os.path.dirname(path)) if name.endswith(".gz"))
+    check(archives == ["audit.log.1.gz", "audit.log.2.gz", "audit.log.3.gz"],
+          f"хранится ровно backups архивов: {archives}")
+    print("✅ ротация и число архивов")
+
+
+async def check_query(tmp: str):
+    path = os.path.join(tmp, "query", "audit.log")
+    os.makedirs(os.path.dirname(path))
+    log = AuditLog(path, max_bytes=400, backups=10)
+    await write(log, range(30))
+    check(any(name.endswith(".gz") for name in os.listdir(os.path.dirname(path))), "записи разложены по архивам")
+
+    entries, total = log.query(limit=5)
+    check(total == 30, f"total считает все записи: {total}")
+    check([e['actor'] for e in entries] == [29, 28, 27, 26, 25], "новые записи первыми")
+
+    # Страницы вместе покрывают журнал без пропусков и повторов
+    seen = []
+    for offset in range(0, 30, 7):
+        page, _ = log.query(offset=offset, limit=7)
+        seen.extend(e['actor'] for e in page)
+    check(seen == list(range(29, -1, -1)), "offset/limit идут через архивы и живой файл")
+
+    page, total = log.query(user_id=1003)
+    check(total == 1 and page[0]['actor'] == 3, "поиск по target")
+    page, total = log.query(offset=40)
+    check(page == [] and total == 30, "страница за концом пуста")
+    print("✅ порядок и постраничный поиск")
+
+
+async def check_requeue(tmp: str):
+    path = os.path.join(tmp, "requeue", "audit.log")
+    os.makedirs(os.path.dirname(path))
+    log = AuditLog(path, max_bytes=10 ** 6, backups=2)
+    write_batch = log._write_batch
+    failures = []
+
+    def failing_write(batch):
+        if not failures:
+            failures.append(len(batch))
+            raise OSError("disk full")
+        write_batch(batch)
+
+    log._write_batch = failing_write
+    log.record('add_user', 1)
+    log.record('add_user', 2)
+    await log.flush()
+    check(failures == [2] and [e['actor'] for e in log._pending] == [1, 2],
+          "неудачная пачка возвращается в очередь один раз")
+    log.record('add_user', 3)
+    await log.flush()
+    entries, total = log.query()
+    check(total == 3 and [e['actor'] for e in entries] == [3, 2, 1], "после повтора каждая запись ровно одна")
+
+    # Ошибка ротации после успешной записи не должна дублировать пачку
+    def failing_rotate():
+        raise OSError("gzip failed")
+
+    log._rotate = failing_rotate
+    log.max_bytes = 1
+    log.record('add_user', 4)
+    await log.flush()
+    check(log._pending == [] and log.query()[1] == 4, "ошибка ротации не возвращает записанную пачку")
+    print("✅ повтор неудачной записи")
+
+
+async def check_replicas(tmp: str):
+    path = os.path.join(tmp, "replicas", "audit.log")
+    os.makedirs(os.path.dirname(path))
+    first = AuditLog(path, max_bytes=300, backups=5, replica_id="host-1")
+    second = AuditLog(path, max_bytes=300, backups=5, replica_id="host-2")
+    for actor in range(20):
+        await write(first if actor % 2 else second, [actor])
+        await asyncio.sleep(0.002)
+
+    names = os.listdir(os.path.dirname(path))
+    check("audit.log" not in names, "реплики не пишут в общий файл")
+    entries, total = second.query(limit=20)
+    check(total == 20 and [e['actor'] for e in entries] == list(range(19, -1, -1)),
+          "query сливает журналы всех реплик по времени")
+    print("✅ журналы реплик")
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        await check_rotation(tmp)
+        await check_query(tmp)
+        await check_requeue(tmp)
+        await check_replicas(tmp)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except AssertionError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
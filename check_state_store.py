@@ -0,0 +1,391 @@
+"""Проверка контракта общего хранилища на SQLite и на сервере с протоколом Redis.
+
+Запуск: python check_state_store.py [--redis-url redis://localhost:6379/15]
+
+Без --redis-url поднимается локальная заглушка RedisStandIn - небольшой
+сервер RESP2 с командами, которые использует RedisStateStore (включая
+TTL ключей и WATCH/MULTI/EXEC). С --redis-url те же проверки идут
+против настоящего сервера; ключи пишутся с отдельным префиксом и
+удаляются после проверки.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import socketserver
+from typing import Dict, List, Optional
+
+from state_store import RedisStateStore, SQLiteStateStore, StateStore
+
+
+class RedisStandIn:
+    """Локальный сервер RESP2 в отдельном потоке"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.data: Dict[str, object] = {}
+        self.expires: Dict[str, float] = {}
+        # Версия ключа растет при каждом изменении - нужна для WATCH
+        self.versions: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        standin = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                watched: Dict[str, int] = {}
+                queued: Optional[List[List[str]]] = None
+                while True:
+                    args = self._read_command()
+                    if args is None:
+                        return
+                    name = args[0].upper()
+                    if name == "WATCH":
+                        with standin.lock:
+                            for key in args[1:]:
+                                watched[key] = standin.versions.get(key, 0)
+                        self.wfile.write(b"+OK\r\n")
+                    elif name == "UNWATCH":
+                        watched.clear()
+                        self.wfile.write(b"+OK\r\n")
+                    elif name == "MULTI":
+                        queued = []
+                        self.wfile.write(b"+OK\r\n")
+                    elif name == "EXEC":
+                        with standin.lock:
+                            if any(standin.versions.get(k, 0) != v for k, v in watched.items()):
+                                self.wfile.write(b"*-1\r\n")
+                            else:
+                                replies = [standin.run(cmd) for cmd in queued or []]
+                                self.wfile.write(b"*%d\r\n" % len(replies) + b"".join(replies))
+                        watched.clear()
+                        queued = None
+                    elif queued is not None:
+                        queued.append(args)
+                        self.wfile.write(b"+QUEUED\r\n")
+                    else:
+                        with standin.lock:
+                            self.wfile.write(standin.run(args))
+
+            def _read_command(self) -> Optional[List[str]]:
+                line = self.rfile.readline()
+                if not line:
+                    return None
+                args = []
+                for _ in range(int(line[1:])):
+                    size = int(self.rfile.readline()[1:])
+                    args.append(self.rfile.read(size + 2)[:-2].decode("utf-8"))
+                return args
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.url = f"redis://{host}:{self.port}/0"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self) -> "RedisStandIn":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # --- выполнение команд (под self.lock) ---
+
+    @staticmethod
+    def _bulk(value: Optional[str]) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        data = value.encode("utf-8")
+        return b"$%d\r\n%s\r\n" % (len(data), data)
+
+    def _array(self, values: List[str]) -> bytes:
+        return b"*%d\r\n" % len(values) + b"".join(self._bulk(v) for v in values)
+
+    def _get(self, key: str):
+        expires_at = self.expires.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            self._delete(key)
+        return self.data.get(key)
+
+    def _touch(self, key: str):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def _delete(self, key: str) -> bool:
+        self.expires.pop(key, None)
+        if key in self.data:
+            del self.data[key]
+            self._touch(key)
+            return True
+        return False
+
+    def run(self, args: List[str]) -> bytes:
+        name, rest = args[0].upper(), args[1:]
+        try:
+            handler = getattr(self, f"cmd_{name.lower()}")
+        except AttributeError:
+            return f"-ERR unknown command '{name}'\r\n".encode("utf-8")
+        return handler(*rest)
+
+    def cmd_ping(self, *args):
+        return b"+PONG\r\n"
+
+    def cmd_auth(self, *args):
+        return b"+OK\r\n"
+
+    def cmd_select(self, db):
+        return b"+OK\r\n"
+
+    def cmd_get(self, key):
+        return self._bulk(self._get(key))
+
+    def cmd_set(self, key, value, *options):
+        options = [o.upper() for o in options]
+        exists = self._get(key) is not None
+        if ("NX" in options and exists) or ("XX" in options and not exists):
+            return self._bulk(None)
+        self.data[key] = value
+        self.expires.pop(key, None)
+        if "PX" in options:
+            self.expires[key] = time.time() + int(options[options.index("PX") + 1]) / 1000
+        if "EX" in options:
+            self.expires[key] = time.time() + int(options[options.index("EX") + 1])
+        self._touch(key)
+        return b"+OK\r\n"
+
+    def cmd_pexpire(self, key, ms):
+        if self._get(key) is None:
+            return b":0\r\n"
+        self.expires[key] = time.time() + int(ms) / 1000
+        self._touch(key)
+        return b":1\r\n"
+
+    def cmd_del(self, *keys):
+        return b":%d\r\n" % sum(self._delete(k) for k in keys if self._get(k) is not None)
+
+    def cmd_sadd(self, key, *members):
+        members_set = self._get(key) or set()
+        added = len(set(members) - members_set)
+        self.data[key] = members_set | set(members)
+        self._touch(key)
+        return b":%d\r\n" % added
+
+    def cmd_srem(self, key, *members):
+        members_set = self._get(key) or set()
+        removed = len(members_set & set(members))
+        if removed:
+            members_set -= set(members)
+            self._touch(key)
+        return b":%d\r\n" % removed
+
+    def cmd_sismember(self, key, member):
+        return b":%d\r\n" % (member in (self._get(key) or set()))
+
+    def cmd_smembers(self, key):
+        return self._array(sorted(self._get(key) or set()))
+
+    def cmd_hset(self, key, *pairs):
+        mapping = self.data.setdefault(key, {})
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in mapping
+            mapping[field] = value
+        self._touch(key)
+        return b":%d\r\n" % added
+
+    def cmd_hget(self, key, field):
+        return self._bulk((self._get(key) or {}).get(field))
+
+    def cmd_hdel(self, key, *fields):
+        mapping = self._get(key) or {}
+        removed = sum(mapping.pop(f, None) is not None for f in fields)
+        if removed:
+            self._touch(key)
+        return b":%d\r\n" % removed
+
+    def cmd_hmget(self, key, *fields):
+        mapping = self._get(key) or {}
+        return b"*%d\r\n" % len(fields) + b"".join(self._bulk(mapping.get(f)) for f in fields)
+
+    def cmd_hgetall(self, key):
+        flat = []
+        for field, value in (self._get(key) or {}).items():
+            flat.extend([field, value])
+        return self._array(flat)
+
+    def cmd_rpush(self, key, *values):
+        items = self.data.setdefault(key, [])
+        items.extend(values)
+        self._touch(key)
+        return b":%d\r\n" % len(items)
+
+    def cmd_lpop(self, key):
+        items = self._get(key) or []
+        if not items:
+            return self._bulk(None)
+        self._touch(key)
+        return self._bulk(items.pop(0))
+
+
+def check_contract(name: str, store: StateStore):
+    """Общие для всех бэкендов гарантии хранилища"""
+    def check(condition, message):
+        if not condition:
+            raise AssertionError(f"{name}: {message}")
+
+    # Белый список
+    store.wl_clear()
+    check(store.wl_add(5) and not store.wl_add(5), "wl_add сообщает, был ли пользователь добавлен")
+    check(store.wl_contains(5) and store.wl_all() == [5], "wl_contains/wl_all видят добавленного")
+    check(store.wl_remove(5) and not store.wl_remove(5), "wl_remove сообщает, был ли пользователь удален")
+
+    # Временные доступы
+    store.grant_set(7, 1000.5)
+    store.grant_set(8, 2000.25)
+    check(store.grants_all() == {7: 1000.5, 8: 2000.25}, "grants_all возвращает точные сроки")
+    check(store.grant_get(8) == 2000.25 and store.grant_get(9) is None, "grant_get возвращает срок или None")
+    check(store.grant_remove([7, 9]) == 1, "grant_remove возвращает число снятых сроков")
+    check(store.grants_all() == {8: 2000.25}, "grant_remove удаляет только указанных")
+
+    # Истечение сроков пачкой, только при совпадении с хранилищем
+    store.grant_remove([8])
+    for user_id in (8, 10, 11):
+        store.wl_add(user_id)
+    store.grant_set(8, 3000.75)
+    store.grant_set(10, 4000.5)
+    store.grant_set(12, 5000.5)
+    expired = store.grant_expire_many([(8, 2000.25), (10, 4000.5), (11, 1000.0), (12, 5000.5)])
+    check(expired == [10], "истекают только совпавшие сроки пользователей из списка")
+    check(store.wl_contains(8) and store.grant_get(8) == 3000.75, "продленный доступ не тронут")
+    check(not store.wl_contains(10) and store.grant_get(10) is None, "истекший доступ удален вместе со сроком")
+    check(store.wl_contains(11), "бессрочный пользователь остается в списке")
+    check(store.grant_get(12) is None, "совпавший срок снимается, даже если пользователя уже нет в списке")
+    check(store.grant_expire_many([]) == [], "пустая пачка ничего не делает")
+    store.wl_add(8)
+    store.wl_clear()
+    check(store.grants_all() == {}, "wl_clear удаляет и временные доступы")
+
+    # Владение сессией с TTL
+    store.claim_session(1, "a", 0.3)
+    check(store.session_owner(1) == "a", "владелец сессии виден сразу")
+    store.release_session(1, "b")
+    check(store.session_owner(1) == "a", "чужая реплика не снимает владение")
+    time.sleep(0.4)
+    check(store.session_owner(1) is None, "владение истекает по TTL")
+    store.claim_session(1, "a", 10)
+    store.release_session(1, "a")
+    check(store.session_owner(1) is None, "владелец снимает владение")
+
+    # Реплики
+    store.heartbeat("a", 10)
+    store.heartbeat("b", 10, draining=True)
+    store.heartbeat("c", 0.3)
+    check(store.live_replicas() == ["a", "c"], "дренируемая реплика не получает новых пользователей")
+    check(store.live_replicas(include_draining=True) == ["a", "b", "c"], "дренируемая реплика жива")
+    time.sleep(0.4)
+    check("c" not in store.live_replicas(include_draining=True), "реплика без heartbeat пропадает")
+    for replica in ("a", "b"):
+        store.remove_replica(replica)
+    check(store.live_replicas(include_draining=True) == [], "remove_replica снимает регистрацию")
+
+    # Блокировка лидера
+    check(store.acquire_lock("p", "a", 0.3), "свободная блокировка берется")
+    check(store.acquire_lock("p", "a", 0.3), "владелец продлевает блокировку")
+    check(not store.acquire_lock("p", "b", 0.3), "занятая блокировка не берется")
+    store.release_lock("p", "b")
+    check(not store.acquire_lock("p", "b", 0.3), "чужая реплика не снимает блокировку")
+    time.sleep(0.4)
+    check(store.acquire_lock("p", "b", 10), "блокировка истекает по TTL")
+    store.release_lock("p", "b")
+    check(store.acquire_lock("p", "a", 10), "владелец освобождает блокировку")
+    store.release_lock("p", "a")
+
+    # Очереди апдейтов
+    for i in range(5):
+        store.push_update("a", f"u{i}")
+    store.push_update("b", "other")
+    check(store.pop_updates("a", limit=3) == ["u0", "u1", "u2"], "очередь FIFO с лимитом")
+    check(store.pop_updates("a") == ["u3", "u4"], "pop_updates забирает остаток")
+    check(store.pop_updates("a") == [], "прочитанные апдейты удаляются")
+    check(store.pop_updates("b") == ["other"], "очереди реплик независимы")
+
+    print(f"✅ {name}: контракт выполнен")
+
+
+def check_redis_race(name: str, url: str, prefix: str):
+    """Продление и освобождение блокировки не трогают ключ, занятый другой репликой"""
+    a = RedisStateStore(url, prefix=prefix)
+    b = RedisStateStore(url, prefix=prefix)
+    try:
+        key = a._key("lock", "race")
+        if not a.acquire_lock("race", "a", 10):
+            raise AssertionError(f"{name}: свободная блокировка не взялась")
+
+        # Между GET и EXEC блокировку перехватывает реплика b
+        original = a.client._roundtrip
+        stolen = []
+
+        def roundtrip(args):
+            reply = original(args)
+            if args[0] == "GET" and not stolen:
+                stolen.append(True)
+                b.client.execute("SET", key, "b", "PX", 10000)
+            return reply
+
+        a.client._roundtrip = roundtrip
+        try:
+            renewed = a.acquire_lock("race", "a", 10)
+        finally:
+            a.client._roundtrip = original
+        if renewed or b.client.execute("GET", key) != "b":
+            raise AssertionError(f"{name}: продление задело чужую блокировку")
+
+        a.release_lock("race", "a")
+        if b.client.execute("GET", key) != "b":
+            raise AssertionError(f"{name}: чужая реплика сняла блокировку")
+        b.release_lock("race", "b")
+        print(f"✅ {name}: гонка продления блокировки")
+    finally:
+        a.close()
+        b.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--redis-url", help="настоящий сервер вместо локальной заглушки")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SQLiteStateStore(os.path.join(tmp, "state.db"))
+        try:
+            check_contract("sqlite", store)
+        finally:
+            store.close()
+
+    standin = None
+    url = args.redis_url
+    if url is None:
+        standin = RedisStandIn().start()
+        url = standin.url
+    name = "redis" if args.redis_url else "redis (stand-in)"
+    prefix = f"qrbot-check-{os.getpid()}"
+    store = RedisStateStore(url, prefix=prefix)
+    try:
+        check_contract(name, store)
+        check_redis_race(name, url, prefix)
+    finally:
+        store.close()
+        if standin is not None:
+            standin.stop()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except AssertionError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
@@ -0,0 +1,581 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+import logging
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+class StateStoreError(Exception):
+    """Ошибка общего хранилища состояния"""
+
+
+class StateStore(ABC):
+    """Общее хранилище состояния для нескольких реплик бота.
+
+    Хранит белый список, владельцев QR-сессий (какая реплика держит
+    Telethon-клиент пользователя), живые реплики, блокировку лидера
+    и очереди пересылаемых апдейтов.
+    """
+
+    # --- белый список ---
+    @abstractmethod
+    def wl_add(self, user_id: int) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def wl_remove(self, user_id: int) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def wl_contains(self, user_id: int) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def wl_all(self) -> List[int]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def wl_clear(self):
+        raise NotImplementedError
+
+    # --- временные доступы ---
+    @abstractmethod
+    def grant_set(self, user_id: int, expires_at: float):
+        raise NotImplementedError
+
+    @abstractmethod
+    def grant_get(self, user_id: int) -> Optional[float]:
+        """Срок доступа пользователя (None - срока нет)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def grant_remove(self, user_ids: List[int]) -> int:
+        """Снять сроки. Возвращает, сколько их было"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def grant_expire_many(self, items: List[Tuple[int, float]]) -> List[int]:
+        """Удалить пользователей, чей срок все еще равен указанному.
+
+        Вся пачка проверяется и удаляется одной транзакцией: срок,
+        продленный или снятый другой репликой, не трогается.
+        Возвращает пользователей, удаленных из списка.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def grants_all(self) -> Dict[int, float]:
+        raise NotImplementedError
+
+    # --- владельцы сессий ---
+    @abstractmethod
+    def claim_session(self, user_id: int, replica_id: str, ttl: float):
+        raise NotImplementedError
+
+    @abstractmethod
+    def release_session(self, user_id: int, replica_id: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def session_owner(self, user_id: int) -> Optional[str]:
+        raise NotImplementedError
+
+    # --- реплики ---
+    @abstractmethod
+    def heartbeat(self, replica_id: str, ttl: float, draining: bool = False):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_replica(self, replica_id: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def live_replicas(self, include_draining: bool = False) -> List[str]:
+        raise NotImplementedError
+
+    # --- блокировки ---
+    @abstractmethod
+    def acquire_lock(self, name: str, owner: str, ttl: float) -> bool:
+        """Взять или продлить блокировку. True, если она принадлежит owner"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def release_lock(self, name: str, owner: str):
+        raise NotImplementedError
+
+    # --- очереди апдейтов ---
+    @abstractmethod
+    def push_update(self, replica_id: str, payload: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def pop_updates(self, replica_id: str, limit: int = 50) -> List[str]:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteStateStore(StateStore):
+    """Хранилище на SQLite — для нескольких процессов на одном хосте"""
+
+    def __init__(self, path: str = "state.db"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS whitelist (user_id INTEGER PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS grants (user_id INTEGER PRIMARY KEY, expires_at REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS session_owners (
+                user_id INTEGER PRIMARY KEY, replica TEXT NOT NULL, expires_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS replicas (
+                replica TEXT PRIMARY KEY, expires_at REAL NOT NULL, draining INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS locks (
+                name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS inbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, replica TEXT NOT NULL, payload TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS inbox_replica ON inbox (replica, id);
+            """
+        )
+        logger.info(f"🗄️ SQLite state store: {path}")
+
+    def _execute(self, sql: str, params=()):
+        with self._lock:
+            try:
+                return self._conn.execute(sql, params)
+            except sqlite3.Error as e:
+                raise StateStoreError(str(e)) from e
+
+    @contextmanager
+    def _immediate(self):
+        """Транзакция BEGIN IMMEDIATE: откат при любой ошибке"""
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    yield self._conn
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+            except sqlite3.Error as e:
+                raise StateStoreError(str(e)) from e
+
+    def _transaction(self, statements):
+        """Выполнить несколько запросов атомарно, вернуть результат последнего"""
+        with self._immediate() as conn:
+            result = None
+            for sql, params in statements:
+                result = conn.execute(sql, params).fetchall()
+            return result
+
+    def wl_add(self, user_id: int) -> bool:
+        cur = self._execute("INSERT OR IGNORE INTO whitelist (user_id) VALUES (?)", (user_id,))
+        return cur.rowcount > 0
+
+    def wl_remove(self, user_id: int) -> bool:
+        cur = self._execute("DELETE FROM whitelist WHERE user_id = ?", (user_id,))
+        return cur.rowcount > 0
+
+    def wl_contains(self, user_id: int) -> bool:
+        row = self._execute("SELECT 1 FROM whitelist WHERE user_id = ?", (user_id,)).fetchone()
+        return row is not None
+
+    def wl_all(self) -> List[int]:
+        return [row[0] for row in self._execute("SELECT user_id FROM whitelist ORDER BY user_id").fetchall()]
+
+    def wl_clear(self):
+        self._execute("DELETE FROM whitelist")
+        self._execute("DELETE FROM grants")
+
+    def grant_set(self, user_id: int, expires_at: float):
+        self._execute("INSERT OR REPLACE INTO grants (user_id, expires_at) VALUES (?, ?)", (user_id, expires_at))
+
+    def grant_get(self, user_id: int) -> Optional[float]:
+        row = self._execute("SELECT expires_at FROM grants WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def grant_remove(self, user_ids: List[int]) -> int:
+        if not user_ids:
+            return 0
+        placeholders = ", ".join("?" * len(user_ids))
+        cur = self._execute(f"DELETE FROM grants WHERE user_id IN ({placeholders})", tuple(user_ids))
+        return cur.rowcount
+
+    def grant_expire_many(self, items: List[Tuple[int, float]]) -> List[int]:
+        removed = []
+        if not items:
+            return removed
+        with self._immediate() as conn:
+            for user_id, expires_at in items:
+                cur = conn.execute("DELETE FROM grants WHERE user_id = ? AND expires_at = ?", (user_id, expires_at))
+                if cur.rowcount and conn.execute("DELETE FROM whitelist WHERE user_id = ?", (user_id,)).rowcount:
+                    removed.append(user_id)
+        return removed
+
+    def grants_all(self) -> Dict[int, float]:
+        return dict(self._execute("SELECT user_id, expires_at FROM grants").fetchall())
+
+    def claim_session(self, user_id: int, replica_id: str, ttl: float):
+        self._execute(
+            "INSERT OR REPLACE INTO session_owners (user_id, replica, expires_at) VALUES (?, ?, ?)",
+            (user_id, replica_id, time.time() + ttl),
+        )
+
+    def release_session(self, user_id: int, replica_id: str):
+        self._execute("DELETE FROM session_owners WHERE user_id = ? AND replica = ?", (user_id, replica_id))
+
+    def session_owner(self, user_id: int) -> Optional[str]:
+        row = self._execute(
+            "SELECT replica FROM session_owners WHERE user_id = ? AND expires_at > ?",
+            (user_id, time.time()),
+        ).fetchone()
+        return row[0] if row else None
+
+    def heartbeat(self, replica_id: str, ttl: float, draining: bool = False):
+        self._execute(
+            "INSERT OR REPLACE INTO replicas (replica, expires_at, draining) VALUES (?, ?, ?)",
+            (replica_id, time.time() + ttl, int(draining)),
+        )
+
+    def remove_replica(self, replica_id: str):
+        self._execute("DELETE FROM replicas WHERE replica = ?", (replica_id,))
+
+    def live_replicas(self, include_draining: bool = False) -> List[str]:
+        sql = "SELECT replica FROM replicas WHERE expires_at > ?"
+        if not include_draining:
+            sql += " AND draining = 0"
+        return [row[0] for row in self._execute(sql + " ORDER BY replica", (time.time(),)).fetchall()]
+
+    def acquire_lock(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        rows = self._transaction([
+            ("DELETE FROM locks WHERE name = ? AND expires_at <= ?", (name, now)),
+            ("INSERT OR IGNORE INTO locks (name, owner, expires_at) VALUES (?, ?, ?)", (name, owner, now + ttl)),
+            ("UPDATE locks SET expires_at = ? WHERE name = ? AND owner = ?", (now + ttl, name, owner)),
+            ("SELECT owner FROM locks WHERE name = ?", (name,)),
+        ])
+        return bool(rows) and rows[0][0] == owner
+
+    def release_lock(self, name: str, owner: str):
+        self._execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+
+    def push_update(self, replica_id: str, payload: str):
+        self._execute("INSERT INTO inbox (replica, payload) VALUES (?, ?)", (replica_id, payload))
+
+    def pop_updates(self, replica_id: str, limit: int = 50) -> List[str]:
+        rows = self._transaction([
+            ("DELETE FROM inbox WHERE replica = ? AND id IN "
+             "(SELECT id FROM inbox WHERE replica = ? ORDER BY id LIMIT ?) RETURNING id, payload",
+             (replica_id, replica_id, limit)),
+        ])
+        return [payload for _, payload in sorted(rows)]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisProtocolClient:
+    """Минимальный синхронный клиент протокола Redis (RESP2).
+
+    Поддерживает только то, что нужно хранилищу, поэтому работает
+    с любым совместимым сервером: Redis, Valkey, KeyDB или локальной заглушкой.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 6379, db: int = 0,
+                 password: Optional[str] = None, timeout: float = 5.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._sock: Optional[socket.socket] = None
+        self._buf = b""
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._buf = b""
+        if self.password:
+            self._roundtrip(("AUTH", self.password))
+        if self.db:
+            self._roundtrip(("SELECT", self.db))
+
+    def _disconnect(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+
+    @staticmethod
+    def _encode(args) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    def _readline(self) -> bytes:
+        while b"\r\n" not in self._buf:
+            chunk = self._sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("connection closed by server")
+            self._buf += chunk
+        line, self._buf = self._buf.split(b"\r\n", 1)
+        return line
+
+    def _readexact(self, size: int) -> bytes:
+        while len(self._buf) < size + 2:
+            chunk = self._sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("connection closed by server")
+            self._buf += chunk
+        data, self._buf = self._buf[:size], self._buf[size + 2:]
+        return data
+
+    def _read_reply(self):
+        line = self._readline()
+        kind, rest = line[:1], line[1:]
+        if kind == b"+":
+            return rest.decode("utf-8")
+        if kind == b"-":
+            raise StateStoreError(rest.decode("utf-8"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            size = int(rest)
+            return None if size < 0 else self._readexact(size).decode("utf-8")
+        if kind == b"*":
+            count = int(rest)
+            return None if count < 0 else [self._read_reply() for _ in range(count)]
+        raise StateStoreError(f"unexpected reply: {line!r}")
+
+    def _roundtrip(self, args):
+        self._sock.sendall(self._encode(args))
+        return self._read_reply()
+
+    def execute(self, *args):
+        with self._lock:
+            for attempt in (1, 2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    return self._roundtrip(args)
+                except (OSError, ConnectionError) as e:
+                    self._disconnect()
+                    if attempt == 2:
+                        raise StateStoreError(f"redis connection error: {e}") from e
+
+    def transaction(self, keys, prepare):
+        """Оптимистичная транзакция WATCH/MULTI/EXEC на одном соединении.
+
+        prepare(call) читает данные через call(*args) и возвращает команды
+        для MULTI/EXEC или None, если делать ничего не нужно. Если ключи
+        изменились до EXEC, транзакция повторяется. Возвращает ответы EXEC.
+        """
+        with self._lock:
+            for attempt in (1, 2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    while True:
+                        self._roundtrip(("WATCH", *keys))
+                        commands = prepare(lambda *args: self._roundtrip(args))
+                        if not commands:
+                            self._roundtrip(("UNWATCH",))
+                            return None
+                        self._roundtrip(("MULTI",))
+                        for command in commands:
+                            self._roundtrip(command)
+                        replies = self._roundtrip(("EXEC",))
+                        if replies is not None:
+                            return replies
+                except (OSError, ConnectionError) as e:
+                    self._disconnect()
+                    if attempt == 2:
+                        raise StateStoreError(f"redis connection error: {e}") from e
+                except StateStoreError:
+                    # Соединение могло остаться внутри MULTI
+                    self._disconnect()
+                    raise
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+
+class RedisStateStore(StateStore):
+    """Хранилище поверх протокола Redis — для реплик на разных хостах"""
+
+    def __init__(self, url: str = "redis://localhost:6379/0", prefix: str = "qrbot"):
+        parsed = urlparse(url)
+        db = parsed.path.lstrip("/")
+        self.client = RedisProtocolClient(
+            host=parsed.hostname or "localhost",
+            port=parsed.port or 6379,
+            db=int(db) if db else 0,
+            password=parsed.password,
+        )
+        self.prefix = prefix
+        self.client.execute("PING")
+        logger.info(f"🗄️ Redis state store: {parsed.hostname}:{parsed.port or 6379}")
+
+    def _key(self, *parts) -> str:
+        return ":".join([self.prefix, *[str(p) for p in parts]])
+
+    def wl_add(self, user_id: int) -> bool:
+        return self.client.execute("SADD", self._key("whitelist"), user_id) == 1
+
+    def wl_remove(self, user_id: int) -> bool:
+        return self.client.execute("SREM", self._key("whitelist"), user_id) == 1
+
+    def wl_contains(self, user_id: int) -> bool:
+        return self.client.execute("SISMEMBER", self._key("whitelist"), user_id) == 1
+
+    def wl_all(self) -> List[int]:
+        return sorted(int(v) for v in self.client.execute("SMEMBERS", self._key("whitelist")) or [])
+
+    def wl_clear(self):
+        self.client.execute("DEL", self._key("whitelist"), self._key("grants"))
+
+    def grant_set(self, user_id: int, expires_at: float):
+        self.client.execute("HSET", self._key("grants"), user_id, repr(expires_at))
+
+    def grant_get(self, user_id: int) -> Optional[float]:
+        value = self.client.execute("HGET", self._key("grants"), user_id)
+        return float(value) if value is not None else None
+
+    def grant_remove(self, user_ids: List[int]) -> int:
+        if not user_ids:
+            return 0
+        return self.client.execute("HDEL", self._key("grants"), *user_ids)
+
+    def grant_expire_many(self, items: List[Tuple[int, float]]) -> List[int]:
+        if not items:
+            return []
+        grants = self._key("grants")
+        matched: List[int] = []
+
+        def prepare(call):
+            current = call("HMGET", grants, *(user_id for user_id, _ in items))
+            matched[:] = [user_id for (user_id, expires_at), value in zip(items, current)
+                          if value == repr(expires_at)]
+            if not matched:
+                return None
+            # Ответ SREM по каждому пользователю показывает, кто был в списке
+            return [("HDEL", grants, *matched)] + [("SREM", self._key("whitelist"), u) for u in matched]
+
+        replies = self.client.transaction([grants], prepare)
+        if not replies:
+            return []
+        return [user_id for user_id, reply in zip(matched, replies[1:]) if reply == 1]
+
+    def grants_all(self) -> Dict[int, float]:
+        flat = self.client.execute("HGETALL", self._key("grants")) or []
+        return {int(flat[i]): float(flat[i + 1]) for i in range(0, len(flat), 2)}
+
+    def claim_session(self, user_id: int, replica_id: str, ttl: float):
+        self.client.execute("SET", self._key("session", user_id), replica_id, "PX", int(ttl * 1000))
+
+    def _if_owner(self, key: str, owner: str, command) -> bool:
+        """Выполнить команду над ключом, только если его значение - owner.
+
+        Проверка и команда идут одной транзакцией WATCH/MULTI/EXEC:
+        ключ, истекший и занятый другой репликой между ними, не трогается.
+        """
+        def prepare(call):
+            if call("GET", key) != owner:
+                return None
+            return [command]
+
+        replies = self.client.transaction([key], prepare)
+        return bool(replies) and replies[0] == 1
+
+    def release_session(self, user_id: int, replica_id: str):
+        key = self._key("session", user_id)
+        self._if_owner(key, replica_id, ("DEL", key))
+
+    def session_owner(self, user_id: int) -> Optional[str]:
+        return self.client.execute("GET", self._key("session", user_id))
+
+    def heartbeat(self, replica_id: str, ttl: float, draining: bool = False):
+        state = "draining" if draining else "active"
+        self.client.execute("SET", self._key("replica", replica_id), state, "PX", int(ttl * 1000))
+        self.client.execute("SADD", self._key("replicas"), replica_id)
+
+    def remove_replica(self, replica_id: str):
+        self.client.execute("DEL", self._key("replica", replica_id))
+        self.client.execute("SREM", self._key("replicas"), replica_id)
+
+    def live_replicas(self, include_draining: bool = False) -> List[str]:
+        live = []
+        for replica_id in self.client.execute("SMEMBERS", self._key("replicas")) or []:
+            state = self.client.execute("GET", self._key("replica", replica_id))
+            if state is None:
+                # Реплика пропала без дренажа — убираем из реестра
+                self.client.execute("SREM", self._key("replicas"), replica_id)
+            elif include_draining or state == "active":
+                live.append(replica_id)
+        return sorted(live)
+
+    def acquire_lock(self, name: str, owner: str, ttl: float) -> bool:
+        key = self._key("lock", name)
+        px = int(ttl * 1000)
+        if self.client.execute("SET", key, owner, "NX", "PX", px) == "OK":
+            return True
+        return self._if_owner(key, owner, ("PEXPIRE", key, px))
+
+    def release_lock(self, name: str, owner: str):
+        key = self._key("lock", name)
+        self._if_owner(key, owner, ("DEL", key))
+
+    def push_update(self, replica_id: str, payload: str):
+        self.client.execute("RPUSH", self._key("inbox", replica_id), payload)
+
+    def pop_updates(self, replica_id: str, limit: int = 50) -> List[str]:
+        key = self._key("inbox", replica_id)
+        payloads = []
+        while len(payloads) < limit:
+            payload = self.client.execute("LPOP", key)
+            if payload is None:
+                break
+            payloads.append(payload)
+        return payloads
+
+    def close(self):
+        self.client.close()
+
+
+def create_state_store(backend: str) -> Optional[StateStore]:
+    """Создать хранилище по имени бэкенда.
+
+    memory — состояние только в памяти процесса (одна реплика),
+    sqlite — файл STATE_DB_PATH, redis — сервер по REDIS_URL.
+    """
+    backend = (backend or "memory").strip().lower()
+    if backend == "memory":
+        return None
+    if backend == "sqlite":
+        return SQLiteStateStore(os.environ.get("STATE_DB_PATH", "state.db"))
+    if backend == "redis":
+        return RedisStateStore(
+            os.environ.get("REDIS_URL", "redis://localhost:6379/0"),
+            prefix=os.environ.get("REDIS_PREFIX", "qrbot"),
+        )
+    raise StateStoreError(f"unknown STATE_BACKEND: {backend}")
@@ -0,0 +1,106 @@
+import os
+import sys
+import mmap
+import struct
+import zlib
+import logging
+from array import array
+from bisect import bisect_left
+from typing import Iterable, Iterator, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Формат файла:
+#   заголовок 24 байта: magic "WLS1", версия (u32), количество (u64), crc32 (u32), резерв (u32)
+#   далее отсортированный массив int64 little-endian без повторов
+SNAPSHOT_MAGIC = b"WLS1"
+SNAPSHOT_VERSION = 1
+HEADER = struct.Struct("<4sIQII")
+ITEM_SIZE = 8
+
+
+class SnapshotError(Exception):
+    """Файл снимка поврежден или имеет неизвестный формат"""
+
+
+def write_snapshot(path: str, user_ids: Iterable[int]):
+    """Атомарно записать снимок белого списка"""
+    ids = array("q", sorted(set(user_ids)))
+    if sys.byteorder != "little":
+        ids.byteswap()
+    payload = ids.tobytes()
+    header = HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(ids), zlib.crc32(payload), 0)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    # Читатели видят либо старый, либо новый файл целиком
+    os.replace(tmp_path, path)
+
+
+class WhitelistSnapshot:
+    """Снимок белого списка, открытый через mmap.
+
+    Данные не копируются в память процесса: страницы файла общие
+    для всех процессов, проверка членства - бинарный поиск.
+    """
+
+    def __init__(self, path: str, verify: bool = True):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            stat = os.fstat(self._file.fileno())
+            self.identity: Tuple[int, int] = (stat.st_ino, stat.st_mtime_ns)
+            if stat.st_size < HEADER.size:
+                raise SnapshotError(f"{path}: файл короче заголовка")
+
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, count, checksum, _ = HEADER.unpack_from(self._mmap, 0)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise SnapshotError(f"{path}: неизвестный формат {magic!r} v{version}")
+            if stat.st_size != HEADER.size + count * ITEM_SIZE:
+                raise SnapshotError(f"{path}: размер не совпадает с заголовком")
+
+            view = memoryview(self._mmap)[HEADER.size:]
+            if verify and zlib.crc32(view) != checksum:
+                view.release()
+                raise SnapshotError(f"{path}: неверная контрольная сумма")
+
+            if sys.byteorder == "little":
+                self._ids = view.cast("q")
+            else:
+                # На big-endian хостах без копии не обойтись
+                swapped = array("q", view.tobytes())
+                swapped.byteswap()
+                view.release()
+                self._ids = memoryview(swapped)
+        except Exception:
+            self.close()
+            raise
+
+    def __contains__(self, user_id: int) -> bool:
+        i = bisect_left(self._ids, user_id)
+        return i < len(self._ids) and self._ids[i] == user_id
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._ids)
+
+    def close(self):
+        """Освободить отображение (все memoryview нужно отпустить до mmap.close)"""
+        ids = getattr(self, "_ids", None)
+        if ids is not None:
+            ids.release()
+            self._ids = None
+        mm = getattr(self, "_mmap", None)
+        if mm is not None:
+            mm.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None